@@ -0,0 +1,188 @@
+from __future__ import with_statement
+import sys
+from optparse import OptionParser
+from StringIO import StringIO
+from timeit import default_timer
+from flask import Flask, Response, render_template, json
+from flaskext.attest import (request_context, app_context, get, post,
+                             TestResponse)
+from flaskext.genshi import Genshi, render_template as render_genshi
+from genshi.template import TemplateLoader
+from jinja2 import FunctionLoader
+
+DEBUG = True
+TESTING = True
+
+TEMPLATES = {'name.html': '{{ name }}', 'name.txt': '${name}'}
+
+
+def load_jinja(name):
+    # the DictLoader of Jinja 2.6 reports every template as outdated
+    return TEMPLATES[name], None, lambda: True
+
+
+def load_genshi(name):
+    return name, name, StringIO(TEMPLATES[name]), lambda: True
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    app.jinja_env.loader = FunctionLoader(load_jinja)
+    genshi = Genshi(app)
+    genshi.template_loader = TemplateLoader([load_genshi])
+
+    @app.route('/', methods=('GET', 'POST'))
+    def index():
+        return 'Hello, World!'
+
+    return app
+
+
+def testapp(**options):
+    @request_context(**options)
+    def testapp():
+        yield create_app()
+    return testapp
+
+
+def measure(func, number, repeat=3):
+    """Best time per call of `func` in seconds, out of `repeat` rounds of
+    `number` calls each."""
+    best = None
+    for _ in xrange(repeat):
+        started = default_timer()
+        for _ in xrange(number):
+            func()
+        elapsed = (default_timer() - started) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_contexts(results):
+    app = create_app()
+
+    def plain():
+        with app.test_request_context():
+            app.test_client()
+    results['context.plain_client'] = measure(plain, 500)
+
+    for scope in ('test', 'process'):
+        context = testapp(scope=scope)
+
+        def enter():
+            with context():
+                pass
+        results['context.request_context.%s' % scope] = measure(enter, 500)
+        context.shutdown()
+
+
+def bench_capture(results):
+    for capture in ('context', None):
+        context = testapp(scope='process', capture=capture)
+        with context():
+            # cached templates, so that it's capturing that is measured
+            # rather than compiling
+            jinja = lambda: render_template('name.html', name='x')
+            genshi = lambda: render_genshi('name.txt', method='text',
+                                           context=dict(name='x'))
+            mode = capture or 'off'
+            results['capture.jinja.%s' % mode] = measure(jinja, 2000)
+            results['capture.genshi.%s' % mode] = measure(genshi, 500)
+        context.shutdown()
+
+
+def bench_equality(results):
+    app = create_app()
+    with app.test_request_context():
+        for size in (1 << 10, 1 << 16, 1 << 20, 1 << 24):
+            body = ['x' * (size >> 4)] * 16
+            fresh = lambda: TestResponse(list(body)) == Response(list(body))
+            results['equality.%dk' % (size >> 10)] = measure(fresh, 10)
+
+
+def bench_decorator(results):
+    app = create_app()
+
+    @get('/')
+    def decorated(response):
+        pass
+
+    @post('/?page=2', data={'message': 'Hello, World!'})
+    def form(response):
+        pass
+
+    def undecorated(client):
+        client.get('/')
+
+    def uncompiled(client):
+        client.post('/?page=2', data={'message': 'Hello, World!'})
+
+    with app_context(app) as client:
+        results['decorator.get'] = measure(lambda: decorated(client), 1000)
+        results['decorator.post'] = measure(lambda: form(client), 1000)
+        results['decorator.none'] = measure(lambda: undecorated(client),
+                                            1000)
+        results['decorator.none.post'] = measure(lambda: uncompiled(client),
+                                                 1000)
+
+
+benchmarks = [bench_contexts, bench_capture, bench_equality, bench_decorator]
+
+
+def compare(results, baseline, tolerance):
+    """Print each result against the baseline, returning the names of
+    those that are slower by more than `tolerance`, a fraction."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            sys.stdout.write('%-36s %12.2fus\n' % (name, results[name] * 1e6))
+            continue
+        ratio = results[name] / baseline[name]
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        sys.stdout.write('%-36s %12.2fus %12.2fus %6.2fx%s\n'
+                         % (name, results[name] * 1e6, baseline[name] * 1e6,
+                            ratio, flag))
+    return regressions
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--save', metavar='FILE',
+                      help='save the results as a baseline')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare the results against a baseline')
+    parser.add_option('-t', '--tolerance', type='float', default=0.2,
+                      help='allowed slowdown against the baseline, as a '
+                           'fraction [default: %default]')
+    options, args = parser.parse_args(argv[1:])
+
+    results = {}
+    for benchmark in benchmarks:
+        benchmark(results)
+
+    baseline = {}
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+    regressions = compare(results, baseline, options.tolerance)
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,8 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import tempfile
-import os
-
 from flask.testing import FlaskClient
-from flaskext.attest import request_context, get
+from flaskext.attest import request_context, sqlite_snapshot, get
 from attest import Tests, assert_hook
 
 import flaskr
@@ -38,18 +35,10 @@ def testapp():
     yield flaskr.app
 
 
-app = Tests(contexts=[testapp])
+# Before each test, set up a blank database
+tempdb = sqlite_snapshot(flaskr.init_db, flaskr.app)
 
-@app.context
-def tempdb():
-    """Before each test, set up a blank database"""
-    fd, flaskr.app.config['DATABASE'] = tempfile.mkstemp()
-    flaskr.init_db()
-    try:
-        yield
-    finally:
-        os.close(fd)
-        os.unlink(flaskr.app.config['DATABASE'])
+app = Tests(contexts=[testapp, tempdb])
 
 
 @app.test
@@ -9,11 +9,8 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import tempfile
-import os
-
 from flask.testing import FlaskClient
-from flaskext.attest import request_context
+from flaskext.attest import request_context, sqlite_snapshot
 from attest import Tests, assert_hook
 
 import minitwit
@@ -66,18 +63,10 @@ def testapp():
     yield minitwit.app
 
 
-app = Tests(contexts=[testapp])
+# Before each test, set up a blank database
+tempdb = sqlite_snapshot(minitwit.init_db, minitwit.app)
 
-@app.context
-def tempdb():
-    """Before each test, set up a blank database"""
-    fd, minitwit.app.config['DATABASE'] = tempfile.mkstemp()
-    minitwit.init_db()
-    try:
-        yield
-    finally:
-        os.close(fd)
-        os.unlink(minitwit.app.config['DATABASE'])
+app = Tests(contexts=[testapp, tempdb])
 
 
 @app.test
@@ -164,5 +153,27 @@ def timelines(client):
     assert 'the message by bar' in rv.data
 
 
+@request_context(queries=True)
+def countedapp():
+    minitwit.app.test_client_class = MiniTwitClient
+    yield minitwit.app
+
+counted = Tests(contexts=[countedapp, tempdb])
+
+
+@counted.test
+def timeline_queries(client, templates, queries):
+    """Make sure the timeline doesn't make a query per message"""
+    client.register_and_login('foo', 'default')
+    for number in range(5):
+        client.add_message('message %d' % number)
+    del queries[:]
+    client.get('/')
+    assert len(queries) <= 2
+    assert not queries.duplicates(parameters=False)
+
+app.register(counted)
+
+
 if __name__ == '__main__':
     app.main()
@@ -1,65 +1,822 @@
 from __future__ import absolute_import
 from __future__ import with_statement
+import __builtin__
+import atexit
+import gc
+import hashlib
+import inspect
+import math
+import os
+import pickle
+import re
+import select
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
 from contextlib import contextmanager
-from flask import (Response, request, template_rendered as jinja_rendered)
-from flask.signals import Namespace
+from difflib import SequenceMatcher
+from functools import partial
+from itertools import islice
+from base64 import b64encode, b64decode
+from gzip import GzipFile
+from StringIO import StringIO
+from weakref import WeakKeyDictionary
+from threading import Thread, Lock, Event, local
+from Queue import Queue, Empty
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from flask import (Response, request, json, _request_ctx_stack,
+                   template_rendered as jinja_rendered)
+from flask.signals import (Namespace, request_started, request_finished,
+                           got_request_exception)
 from flask.testing import FlaskClient
+from werkzeug.test import EnvironBuilder
 from decorator import decorator
+from attest import (Tests, statistics, capture_output, auto_reporter,
+                    AbstractReporter, TestResult)
 
 
-def request_context(appfactory):
+def request_context(appfactory=None, scope='test', reset=None,
+                    capture='context', capture_limit=None, profiler=None,
+                    recorder=None, client_pool=None, queries=False):
     """Decorator that creates a test context out of a function that returns
-    a Flask application."""
+    a Flask application.
+
+    By default the application is created anew for every test. With
+    ``scope='process'`` the factory is entered once, the first time the
+    context is used, and the application is kept for the rest of the
+    process; only the request context and the test client are recreated
+    per test. The `reset` callable is then called with the application
+    after each test, to undo any state the test left behind. The cached
+    application is torn down at exit, or earlier with the
+    ``shutdown()`` method of the returned context, for example at the end
+    of a suite::
+
+        @request_context(scope='process', reset=lambda app: db.clear())
+        def testapp():
+            yield create_app(__name__)
+
+    Its ``warm()`` method builds the application ahead of time and fills
+    its caches, the URL map and the compiled templates, as
+    :func:`run_forked` does before forking.
+
+    The `capture` mode decides what goes in the templates list:
+    ``'context'`` records the name and context of every rendering,
+    ``'names'`` records the name only with :const:`None` for the context,
+    a sequence of key names records a shallow copy of only those context
+    variables and :const:`None` turns capturing off, leaving the list
+    empty and the template signals unconnected, unless a `profiler` or a
+    running :class:`DependencyIndex` needs them. With a `capture_limit`
+    only that many of the latest renderings are kept.
+
+    A :class:`Profiler` passed as `profiler` records the time spent setting
+    up each test and the cost of every request made by the test client,
+    and a :class:`Recorder` passed as `recorder` saves the requests and
+    their responses for :func:`replay`. With a :class:`ClientPool` as
+    `client_pool`, test clients are reused between tests, which requires
+    ``scope='process'`` since a client is bound to its application.
+
+    With ``queries=True`` a :class:`QueryLog` of the SQLite queries made
+    by the requests of the test client is passed to tests as well, after
+    the templates list.
+
+    """
+    if appfactory is None:
+        return lambda appfactory: request_context(appfactory, scope, reset,
+                                                  capture, capture_limit,
+                                                  profiler, recorder,
+                                                  client_pool, queries)
+    if scope not in ('test', 'process'):
+        raise ValueError('unknown scope %r' % (scope,))
+    if client_pool is not None and scope != 'process':
+        raise ValueError("client_pool requires scope='process'")
+    if isinstance(capture, basestring) and capture not in ('context',
+                                                           'names'):
+        raise ValueError('unknown capture mode %r' % (capture,))
+
+    factory = contextmanager(appfactory)
+    cached = []
+
+    def wire(app):
+        if capture or profiler is not None or _sinks or _loaders:
+            _wire(app)
+
+    @contextmanager
+    def application():
+        if scope == 'test':
+            with factory() as app:
+                wire(app)
+                yield app
+            return
+        if not cached:
+            manager = factory()
+            app = manager.__enter__()
+            wire(app)
+            cached.append((manager, app, os.getpid()))
+        app = cached[0][1]
+        try:
+            yield app
+        finally:
+            if reset is not None:
+                reset(app)
+
+    def shutdown():
+        """Tear down the cached application, if any."""
+        if cached:
+            manager, app, pid = cached.pop()
+            # forked children inherit the cache but not its ownership
+            if pid == os.getpid():
+                manager.__exit__(None, None, None)
+
+    def warm():
+        """Build the cached application ahead of the tests and fill its
+        caches, if the scope is the process."""
+        if scope == 'process':
+            with application() as app:
+                _warm(app)
 
     @contextmanager
     def test_request_context():
-        with contextmanager(appfactory)() as app:
-            templates = []
+        if profiler is not None:
+            profiler.begin()
+        try:
+            with application() as app:
+                # in case an index started after the application was built
+                wire(app)
+                templates = []
+                with app_context(app, profiler, recorder,
+                                 client_pool) as client:
+                    with _capturing(templates, capture, capture_limit):
+                        if profiler is not None:
+                            profiler.started()
+                        if not queries:
+                            yield client, templates
+                            return
+                        with _logging_queries(client) as log:
+                            yield client, templates, log
+        finally:
+            if profiler is not None:
+                profiler.end()
 
-            def capture(sender, template, context):
-                templates.append((template, context))
+    test_request_context.shutdown = shutdown
+    test_request_context.warm = warm
+    if scope == 'process':
+        _scoped[test_request_context] = 'shutdown'
+        _warmers[test_request_context] = True
+    return test_request_context
 
-            @jinja_rendered.connect_via(app)
-            def signal_jinja(sender, template, context):
-                template_rendered.send(None, template=template.name,
-                                       context=context)
 
-            try:
-                from flaskext.genshi import template_generated
-            except ImportError:
-                pass
-            else:
-                @template_generated.connect_via(app)
-                def signal_genshi(sender, template, context):
-                    template_rendered.send(None, template=template.filename,
-                                       context=context)
+# What holds on to something until the process exits, mapped to the name of
+# the method that lets go of it. The references are weak so that contexts
+# replaced by reloading their module don't pile up.
+_scoped = WeakKeyDictionary()
 
-            with app_context(app) as client:
-                with template_rendered.connected_to(capture):
-                    yield client, templates
+def _shutdown_scoped():
+    """Tear down everything cached by process-scoped contexts."""
+    for owner, name in _scoped.items():
+        getattr(owner, name)()
 
-    return test_request_context
+atexit.register(_shutdown_scoped)
+
+_warmers = WeakKeyDictionary()
+
+def _warm(app):
+    """Build the URL map and compile every template of `app`."""
+    app.url_map.update()
+    env = app.jinja_env
+    try:
+        names = env.list_templates()
+    except TypeError:
+        # the loader can't list its templates
+        names = []
+    for name in names:
+        try:
+            env.get_template(name)
+        except Exception:
+            # broken templates are for the tests using them to report
+            pass
+
+
+@contextmanager
+def _capturing(templates, mode, limit):
+    """Append renderings to `templates` during the context, according to
+    the capture `mode` of :func:`request_context`."""
+    if not mode:
+        yield
+        return
+    if mode == 'context':
+        entry = lambda rendering: rendering
+    elif mode == 'names':
+        entry = lambda rendering: rendering.replace(None)
+    else:
+        keys = tuple(mode)
+        entry = lambda rendering: rendering.replace(dict(
+            (key, rendering[1][key]) for key in keys if key in rendering[1]))
+
+    def sink(rendering):
+        templates.append(entry(rendering))
+        if limit is not None and len(templates) > limit:
+            del templates[0]
+
+    _sinks.append(sink)
+    try:
+        yield
+    finally:
+        _sinks.remove(sink)
+
+
+#: Capture functions of the tests currently running, called directly with
+#: a :class:`Rendering` of each rendered template.
+_sinks = []
+
+#: Functions called with the name of every template loaded, including
+#: those extended, included or imported by the rendered ones.
+_loaders = []
+
+#: Applications that already have their template signals wired to
+#: :func:`_dispatch`.
+_wired = WeakKeyDictionary()
+
+_unresolved = object()
+_genshi_generated = _unresolved
+
+
+#: What is known of templates about to be rendered in this thread, by
+#: template object.
+_renderings = local()
+
+
+def _dispatch(rendering):
+    for sink in _sinks:
+        sink(rendering)
+
+
+def _wire(app):
+    """Connect the template signals of `app` to the capture sinks, once per
+    application. The optional Flask-Genshi integration is looked up once
+    per process."""
+    global _genshi_generated
+    if app in _wired:
+        return
+    if _genshi_generated is _unresolved:
+        try:
+            from flaskext.genshi import template_generated
+        except ImportError:
+            template_generated = None
+        _genshi_generated = template_generated
+    env = app.jinja_env
+    seen = WeakKeyDictionary()
+    env.get_template = partial(_get_template, env.get_template, seen)
+    env.from_string = partial(_from_string, env.from_string)
+    jinja_rendered.connect(_jinja_rendered, app)
+    if _genshi_generated is not None:
+        extension = getattr(app, 'extensions', {}).get('genshi')
+        if extension is not None:
+            loader = extension.template_loader
+            loader.load = partial(_get_template, loader.load,
+                                  WeakKeyDictionary())
+        _genshi_generated.connect(_genshi_rendered, app)
+    _wired[app] = True
+
+
+def _rendering_info(template):
+    info = getattr(_renderings, 'info', None)
+    if info is None:
+        info = _renderings.info = {}
+    return info.setdefault(template, {})
+
+
+def _get_template(get_template, seen, *args, **kwargs):
+    """Get a template, noting whether it was seen before, which means it
+    came out of the cache rather than being compiled."""
+    template = get_template(*args, **kwargs)
+    _rendering_info(template)['cached'] = template in seen
+    seen[template] = True
+    _time_render(template)
+    if _loaders:
+        name = getattr(template, 'name', None) or \
+            getattr(template, 'filename', None)
+        for loaded in _loaders:
+            loaded(name)
+    return template
+
+
+def _from_string(from_string, *args, **kwargs):
+    template = from_string(*args, **kwargs)
+    _rendering_info(template)['cached'] = False
+    _time_render(template)
+    return template
+
+
+def _time_render(template):
+    if 'render' in vars(template) or not hasattr(template, 'render'):
+        return
+    render = template.render
+
+    def timed_render(*args, **kwargs):
+        started = time.time()
+        output = render(*args, **kwargs)
+        _rendering_info(template).update(duration=time.time() - started,
+                                         size=len(output))
+        return output
+    template.render = timed_render
+
+
+def _pop_rendering_info(template):
+    info = getattr(_renderings, 'info', None)
+    if not info:
+        return {}
+    found = info.pop(template, {})
+    # templates fetched for includes and imports are rendered as part of
+    # this one, and never reported by themselves
+    info.clear()
+    return found
+
+
+def _jinja_rendered(sender, template, context):
+    _dispatch(Rendering(template.name, context,
+                        **_pop_rendering_info(template)))
+
+
+def _genshi_rendered(sender, template, context):
+    info = _pop_rendering_info(template)
+    if template.filename is None:
+        info['cached'] = False
+    # the stream is only rendered after the signal, so there's no timing
+    info.pop('duration', None)
+    info.pop('size', None)
+    _dispatch(Rendering(template.filename, context, **info))
+
+
+def _forward(sender, template, context, duration=None, cached=None,
+             size=None):
+    _dispatch(Rendering(template, context, duration, cached, size))
+
+
+class Rendering(tuple):
+    """An entry of the templates list: a ``(name, context)`` pair of the
+    template and the context it was rendered with, with what is known of
+    the cost of rendering it as attributes. Those that aren't known are
+    :const:`None`. ::
+
+        @frontend.test
+        @get('/')
+        def index(response, templates):
+            assert templates[0].duration < 0.05
+            assert templates[0].cached
+
+    For Jinja all are known, except that templates rendered from a string
+    are always compiled. For Genshi only whether the template was cached
+    is known, since it's rendered after the fact.
+
+    """
+
+    def __new__(cls, name, context, duration=None, cached=None, size=None):
+        self = tuple.__new__(cls, (name, context))
+        #: Seconds it took to render the template.
+        self.duration = duration
+        #: Whether the template was reused from the cache, rather than
+        #: compiled for this rendering.
+        self.cached = cached
+        #: Length of the output, in characters.
+        self.size = size
+        return self
+
+    name = property(lambda self: self[0], doc='Name of the template.')
+    context = property(lambda self: self[1],
+                       doc='Context the template was rendered with.')
 
+    def replace(self, context):
+        """A copy with another `context`."""
+        return Rendering(self[0], context, self.duration, self.cached,
+                         self.size)
+
+
+def sqlite_snapshot(init_db, app=None, key='DATABASE'):
+    """Create a test context that gives each test a fresh SQLite database,
+    without running the schema for every test. The first time the context
+    is entered, `init_db` is called to build the database in a temporary
+    file that is then kept as a snapshot; each test gets its own copy of
+    that file, with its path in the `key` of the application config. ::
+
+        tempdb = sqlite_snapshot(minitwit.init_db, minitwit.app)
+        app = Tests(contexts=[testapp, tempdb])
+
+    Without `app`, the application is the current one when the context is
+    entered, so that it works with applications created anew for every
+    test by :func:`request_context`, listed before it::
+
+        tempdb = sqlite_snapshot(init_db)
+
+    The context yields nothing, so it doesn't change what arguments tests
+    receive. The snapshot is removed at exit, or earlier with the
+    ``shutdown()`` method of the returned context.
+
+    """
+    snapshot = []
+
+    @contextmanager
+    def database():
+        target = app
+        if target is None:
+            if _request_ctx_stack.top is None:
+                raise RuntimeError('sqlite_snapshot needs an application: '
+                                   'list it after a request_context or '
+                                   'pass one')
+            target = _request_ctx_stack.top.app
+        config = target.config
+        if not snapshot:
+            config[key] = _mktemp()
+            init_db()
+            snapshot.append((config[key], os.getpid()))
+        path = _mktemp()
+        shutil.copyfile(snapshot[0][0], path)
+        config[key] = path
+        try:
+            yield
+        finally:
+            os.unlink(path)
+
+    def shutdown():
+        """Remove the snapshot, if any."""
+        if snapshot:
+            path, pid = snapshot.pop()
+            if pid == os.getpid():
+                os.unlink(path)
+
+    database.shutdown = shutdown
+    _scoped[database] = 'shutdown'
+    return database
+
+
+def sqlite_transaction(target, name='connect_db'):
+    """Create a test context that runs each test in one SQLite transaction
+    that is rolled back when the test ends, leaving the database as it was.
+    The function `name` of `target`, which the application calls to
+    connect to its database, is replaced for the duration of the test so
+    that every request shares the one connection and thereby the
+    transaction. Commits and closes on the shared connection do nothing,
+    and rollbacks only roll back to the start of the test. ::
+
+        transaction = sqlite_transaction(minitwit)
+        app = Tests(contexts=[testapp, transaction])
+
+    The database needs to exist with its schema before the test starts,
+    and the test shouldn't run scripts with
+    :meth:`~sqlite3.Cursor.executescript` because that commits first.
+    SQLite connections can't be used from other threads, so this doesn't
+    work with :func:`load`.
+
+    """
+
+    @contextmanager
+    def transaction():
+        connect = getattr(target, name)
+        connection = connect()
+        connection.isolation_level = None
+        connection.execute('BEGIN')
+        connection.execute('SAVEPOINT attest')
+        shared = _SharedConnection(connection)
+        setattr(target, name, lambda *args, **kwargs: shared)
+        try:
+            yield
+        finally:
+            setattr(target, name, connect)
+            connection.execute('ROLLBACK')
+            connection.close()
+
+    return transaction
+
+
+class _SharedConnection(object):
+    """Proxy for the connection of :func:`sqlite_transaction`."""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.rollback()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._connection.execute('ROLLBACK TO SAVEPOINT attest')
+
+    def close(self):
+        pass
+
+
+def _mktemp():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    return path
+
+
+_sqlite_connect = sqlite3.connect
+_querying = local()
+_query_logs = []
 
 @contextmanager
-def app_context(app):
+def _logging_queries(client):
+    """Log the queries of the requests made by `client`. SQLite connects
+    through a connection that logs queries while any log is active."""
+    log = QueryLog()
+    log.instrument(client)
+    if not _query_logs:
+        sqlite3.connect = sqlite3.dbapi2.connect = _connect
+    _query_logs.append(log)
+    try:
+        yield log
+    finally:
+        _query_logs.remove(log)
+        if not _query_logs:
+            sqlite3.connect = sqlite3.dbapi2.connect = _sqlite_connect
+
+
+def _connect(*args, **kwargs):
+    kwargs.setdefault('factory', _LoggingConnection)
+    return _sqlite_connect(*args, **kwargs)
+
+
+def _log_query(sql, parameters, duration):
+    log = getattr(_querying, 'log', None)
+    if log is not None:
+        path = request.path if request else None
+        log.append(Query(sql, parameters, duration, path))
+
+
+class _LoggingCursor(sqlite3.Cursor):
+    """Cursor that times its queries for :func:`_log_query`."""
+
+    def execute(self, sql, parameters=()):
+        started = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            _log_query(sql, parameters, time.time() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            _log_query(sql, seq_of_parameters, time.time() - started)
+
+
+class _LoggingConnection(sqlite3.Connection):
+    """Connection whose cursors, including those made by
+    :meth:`~sqlite3.Connection.execute`, are logging cursors."""
+
+    def cursor(self, factory=_LoggingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+class QueryLog(list):
+    """The :class:`Query` records of the requests made by a test client,
+    in order. Passed to tests by a :func:`request_context` with
+    ``queries=True``::
+
+        @request_context(queries=True)
+        def testapp():
+            yield create_app(__name__)
+
+        @timeline.test
+        @get('/public')
+        def public_timeline(response, templates, queries):
+            assert len(queries) <= 3
+            assert not queries.duplicates(parameters=False)
+
+    Queries are logged for SQLite connections opened with
+    :func:`sqlite3.connect` while the log is active, which includes those
+    the application opens per request and those opened by test contexts
+    after this one. Connections opened before, or with a `factory` of
+    their own, aren't logged.
+
+    """
+
+    def instrument(self, client):
+        """Log the queries of every request made by a test client."""
+        client.open = partial(self._open, client.open)
+
+    def _open(self, open, *args, **kwargs):
+        previous = getattr(_querying, 'log', None)
+        _querying.log = self
+        try:
+            return open(*args, **kwargs)
+        finally:
+            _querying.log = previous
+
+    @property
+    def total_time(self):
+        """Seconds spent in all the queries."""
+        return sum(query.duration for query in self)
+
+    def duplicates(self, parameters=True):
+        """Statements made more than once, mapped to how many times. The
+        keys are ``(sql, parameters)`` pairs, or only the SQL when
+        `parameters` is false, which finds the many similar queries of a
+        view with an N+1 problem."""
+        counts = {}
+        for query in self:
+            key = query.sql
+            if parameters:
+                key = key, _hashable(query.parameters)
+            counts[key] = counts.get(key, 0) + 1
+        return dict((key, count) for key, count in counts.iteritems()
+                    if count > 1)
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item))
+                            for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+class Query(object):
+    """A query logged in a :class:`QueryLog`."""
+
+    def __init__(self, sql, parameters, duration, path):
+        #: The SQL statement.
+        self.sql = sql
+        #: The parameters of the statement, or a list of them for
+        #: :meth:`~sqlite3.Cursor.executemany`.
+        self.parameters = parameters
+        #: Seconds the query took.
+        self.duration = duration
+        #: Path of the request that made the query.
+        self.path = path
+
+    def __repr__(self):
+        return '<Query %s %r %r>' % (self.path, self.sql, self.parameters)
+
+
+@contextmanager
+def app_context(app, profiler=None, recorder=None, client_pool=None):
     with app.test_request_context():
         cls = getattr(app, 'test_client_class', None) or FlaskClient
-        with cls(app, TestResponse) as client:
-            yield client
+        if client_pool is None:
+            client = cls(app, TestResponse)
+        else:
+            client = client_pool.acquire(app, cls)
+        try:
+            with client:
+                if profiler is not None:
+                    profiler.instrument(client)
+                if recorder is not None:
+                    recorder.instrument(client)
+                yield client
+        finally:
+            if client_pool is not None:
+                client_pool.release(client)
+
+
+class ClientPool(object):
+    """Keeps test clients around for reuse by later tests, instead of
+    creating a new one for every test. A client is reset before it's
+    reused: its cookies, and thereby the session, are cleared, its
+    `environ_base` is restored if it has one, and any instrumentation is
+    removed. A client class can define a ``reset()`` method to reset
+    state of its own. The pool is safe to use from several threads, and
+    forked workers each get their own copy.
+
+    Idle clients are kept on their application, so they go away with it.
+    Clients are only ever reused for the same application, which is why
+    :func:`request_context` only takes a pool with ``scope='process'``. ::
+
+        @request_context(scope='process', client_pool=ClientPool())
+        def testapp():
+            yield create_app(__name__)
+
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+
+    def acquire(self, app, cls):
+        """Get a reset client of the class `cls` for `app`, creating one if
+        none is idle."""
+        with self._lock:
+            idle = getattr(app, '_attest_idle_clients', {})
+            clients = idle.get((self, cls))
+            client = clients.pop() if clients else None
+        if client is None:
+            client = cls(app, TestResponse)
+            environ_base = getattr(client, 'environ_base', None)
+            if environ_base is not None:
+                client._attest_environ_base = dict(environ_base)
+            return client
+        if client.cookie_jar is not None:
+            client.cookie_jar.clear()
+        if hasattr(client, '_attest_environ_base'):
+            client.environ_base = dict(client._attest_environ_base)
+        client.__dict__.pop('open', None)
+        if hasattr(client, 'reset'):
+            client.reset()
+        return client
+
+    def release(self, client):
+        """Return a client to the pool."""
+        app = client.application
+        with self._lock:
+            if not hasattr(app, '_attest_idle_clients'):
+                app._attest_idle_clients = {}
+            clients = app._attest_idle_clients.setdefault(
+                (self, type(client)), [])
+            clients.append(client)
 
 
 def open(*args, **kwargs):
     """Wraps a test with a call to :meth:`~werkzeug.test.Client.open` on
     the test client, passing the response instead of the client to the
     test."""
+    compiled = CompiledRequest(args, kwargs)
+
     @decorator
     def wrapper(func, client, *wrapperargs, **wrapperkwargs):
-        response = client.open(*args, **kwargs)
+        openargs, openkwargs = compiled.arguments()
+        response = client.open(*openargs, **openkwargs)
         return func(response, *wrapperargs, **wrapperkwargs)
+    wrapper.request = args, kwargs
+    wrapper.compiled = compiled
     return wrapper
 
 
+class CompiledRequest(object):
+    """A request for :meth:`~werkzeug.test.Client.open`, built by
+    :class:`~werkzeug.test.EnvironBuilder` only once into a WSGI environ
+    that is copied for every run, rather than encoding the form data and
+    parsing the URL all over again. The environ is built on first use. ::
+
+        request = CompiledRequest(('/add',), dict(method='POST',
+                                                  data={'title': 'Hello'}))
+        for _ in xrange(1000):
+            args, kwargs = request.arguments()
+            client.open(*args, **kwargs)
+
+    """
+
+    #: Arguments that are for the client rather than the builder.
+    client_options = ('as_tuple', 'buffered', 'follow_redirects')
+
+    def __init__(self, args, kwargs):
+        self.args, self.kwargs = args, dict(kwargs)
+        self.options = dict((key, self.kwargs.pop(key))
+                            for key in self.client_options
+                            if key in self.kwargs)
+        self._environ = self._body = None
+
+    def compile(self):
+        """Build the environ, unless it already is."""
+        if self._environ is not None:
+            return
+        builder = EnvironBuilder(*self.args, **self.kwargs)
+        try:
+            environ = builder.get_environ()
+            body = environ.pop('wsgi.input').read()
+        finally:
+            builder.close()
+        # the default error stream is whatever stderr is at the time of the
+        # request, which differs between runs when output is captured
+        if self.kwargs.get('errors_stream') is None:
+            del environ['wsgi.errors']
+        self._body, self._environ = body, environ
+
+    def environ(self):
+        """A fresh copy of the environ, with its own input stream."""
+        self.compile()
+        environ = dict(self._environ)
+        environ['wsgi.input'] = StringIO(self._body)
+        environ.setdefault('wsgi.errors', sys.stderr)
+        return environ
+
+    def arguments(self):
+        """Positional and keyword arguments for
+        :meth:`~werkzeug.test.Client.open` making the request. The environ
+        is passed as ``environ_overrides``, since the Flask test client
+        adds to those and so can't take an environ of its own."""
+        kwargs = dict(self.options)
+        kwargs['environ_overrides'] = self.environ()
+        return (), kwargs
+
+
 def get(*args, **kwargs):
     """Decorates a test to issue a GET request to the application. This is
     sugar for ``@open(method='GET')``. Arguments are the same as to
@@ -97,21 +854,2201 @@ def head(*args, **kwargs):
     return open(*args, **kwargs)
 
 
+def load(*requests, **options):
+    """Wraps a test with a load test of the application, passing a
+    :class:`LoadReport` instead of the client to the test. The `requests`
+    are the decorators returned by :func:`open` and its shortcuts, or
+    ``(weight, request)`` pairs to mix them in proportion to the weights.
+    They are replayed `total` times in all, defaulting to 100, by
+    `concurrency` threads, defaulting to 4, each with its own request
+    context and test client. ::
+
+        @frontend.test
+        @load(get('/'), (3, get('/public')), total=1000, concurrency=8)
+        def timelines(report):
+            assert not report.errors
+            assert report.p95 < 0.05
+
+    """
+    total = options.pop('total', 100)
+    concurrency = options.pop('concurrency', 4)
+    if options:
+        raise TypeError('unexpected options %s' % ', '.join(options))
+    pattern = []
+    for item in requests:
+        weight = 1
+        if isinstance(item, tuple):
+            weight, item = item
+        pattern.extend([item.compiled] * weight)
+    if not pattern:
+        raise TypeError('load needs a request with a positive weight')
+
+    @decorator
+    def wrapper(func, client, *wrapperargs, **wrapperkwargs):
+        jobs = Queue()
+        for index in xrange(total):
+            jobs.put(pattern[index % len(pattern)])
+        report = LoadReport()
+        app = client.application
+        cls = type(client)
+        workers = [Thread(target=_load_worker, args=(app, cls, jobs, report))
+                   for _ in xrange(concurrency)]
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        report.elapsed = time.time() - started
+        report.latencies.sort()
+        return func(report, *wrapperargs, **wrapperkwargs)
+    return wrapper
+
+
+def _load_worker(app, cls, jobs, report):
+    with app.test_request_context():
+        client = cls(app, TestResponse)
+        while True:
+            try:
+                args, kwargs = jobs.get_nowait().arguments()
+            except Empty:
+                return
+            started = time.time()
+            try:
+                response = client.open(*args, **kwargs)
+                for chunk in response.iter_encoded():
+                    pass
+                response.close()
+            except Exception:
+                report.errors.append(sys.exc_info()[1])
+                continue
+            report.add(time.time() - started, response)
+
+
+class LoadReport(object):
+    """Results of a :func:`load` test. Latencies are in seconds."""
+
+    def __init__(self):
+        #: Sorted latencies of all completed requests.
+        self.latencies = []
+        #: Exceptions raised by requests, and responses with a status code
+        #: of 500 and above.
+        self.errors = []
+        #: Number of responses by status code.
+        self.statuses = {}
+        #: Wall time of the whole test.
+        self.elapsed = 0.0
+        self._lock = Lock()
+
+    def add(self, latency, response):
+        """Record a completed request."""
+        with self._lock:
+            self.latencies.append(latency)
+            code = response.status_code
+            self.statuses[code] = self.statuses.get(code, 0) + 1
+            if code >= 500:
+                self.errors.append(response)
+
+    @property
+    def requests(self):
+        """Number of completed requests."""
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        """Completed requests per second."""
+        if not self.elapsed:
+            return 0.0
+        return self.requests / self.elapsed
+
+    def percentile(self, percent):
+        """The latency below which `percent` percent of requests
+        completed, by the nearest-rank method."""
+        if not self.latencies:
+            return None
+        rank = int(math.ceil(percent / 100.0 * len(self.latencies)))
+        return self.latencies[max(rank, 1) - 1]
+
+    p50 = property(lambda self: self.percentile(50))
+    p95 = property(lambda self: self.percentile(95))
+    p99 = property(lambda self: self.percentile(99))
+
+
+def batch(rows):
+    """Wraps a test with a table of requests to issue with the one test
+    client, passing an iterator of :class:`BatchRow` results instead of the
+    client to the test. Each row is a pair of a request and what to expect
+    of the response. The request is one of the decorators returned by
+    :func:`open` and its shortcuts, or simply a path to GET. The
+    expectation is a status code or a response object to compare against.
+    Requests are issued one at a time, as the test iterates. ::
+
+        @frontend.test
+        @batch([('/', 200),
+                ('/missing', 404),
+                (get('/api/'), jsonify(status='All systems go.'))])
+        def routes(rows):
+            for row in rows:
+                assert row.passed, row
+
+    This is a lot cheaper than a test per request when there are many of
+    them, since the application and contexts are only set up once.
+
+    """
+
+    @decorator
+    def wrapper(func, client, *wrapperargs, **wrapperkwargs):
+        return func(_iter_batch(client, rows), *wrapperargs, **wrapperkwargs)
+    return wrapper
+
+
+def _iter_batch(client, rows):
+    for item, expected in rows:
+        if isinstance(item, basestring):
+            args, kwargs = (item,), {}
+            response = client.open(item)
+        else:
+            args, kwargs = item.request
+            openargs, openkwargs = item.compiled.arguments()
+            response = client.open(*openargs, **openkwargs)
+        yield BatchRow(args, kwargs, response, expected)
+
+
+class BatchRow(object):
+    """The result of a request made by :func:`batch`. The response is
+    compared once, when the row is made, so the row can be checked and
+    shown any number of times even if the body could be read only once."""
+
+    def __init__(self, args, kwargs, response, expected):
+        #: The arguments the request was made with.
+        self.args, self.kwargs = args, kwargs
+        #: The :class:`TestResponse`.
+        self.response = response
+        #: The expected status code or response.
+        self.expected = expected
+        self._expected = self._mismatch = None
+        if isinstance(expected, (int, long)):
+            #: Whether the response is as expected.
+            self.passed = response.status_code == expected
+        else:
+            self.passed = response == expected
+            self._expected = response._attest_expected
+
+    def __repr__(self):
+        path = self.args[0] if self.args else self.kwargs.get('path', '/')
+        if isinstance(self.expected, (int, long)):
+            expected = self.expected
+        else:
+            expected = self.expected.status_code
+        text = '<BatchRow %s %s: %s, expected %s%s>' % (
+            self.kwargs.get('method', 'GET'), path, self.response.status_code,
+            expected, '' if self.passed else ' (failed)')
+        if self._expected is not None:
+            if self._mismatch is None:
+                other, environ = self._expected
+                self._mismatch = ResponseDiff(self.response, other,
+                                              environ=environ)
+            text = '%s\n%s' % (text, self._mismatch)
+        return text
+
+
+def concurrently(*requests, **options):
+    """Wraps a test with the `requests` issued all at once, passing the
+    list of responses in the same order instead of the client to the test.
+    The requests are the decorators returned by :func:`open` and its
+    shortcuts, and they share the cookies of the test client. ::
+
+        @timeline.test
+        @concurrently(get('/foo/follow'), get('/foo/unfollow'))
+        def follow_race(responses):
+            assert all(r.status_code == 302 for r in responses)
+
+    `workers` sets the number of threads, defaulting to one per request.
+
+    """
+    workers = options.pop('workers', len(requests))
+    if options:
+        raise TypeError('unexpected options %s' % ', '.join(options))
+
+    @decorator
+    def wrapper(func, client, *wrapperargs, **wrapperkwargs):
+        with ConcurrentClient(client.application, workers, client) as pool:
+            futures = [pool.open(*args, **kwargs) for args, kwargs
+                       in (item.compiled.arguments() for item in requests)]
+            responses = [future.result() for future in futures]
+        return func(responses, *wrapperargs, **wrapperkwargs)
+    return wrapper
+
+
+class ConcurrentClient(object):
+    """A test client that issues requests from a pool of `workers` threads,
+    each with its own request context and client, returning a
+    :class:`Future` for every request instead of waiting for it. If a
+    `client` is given the threads share its cookies. ::
+
+        with ConcurrentClient(app, 8, client) as pool:
+            futures = [pool.get('/%s/follow' % name) for name in names]
+            for future in futures:
+                assert future.result().status_code == 302
+
+    """
+
+    def __init__(self, app, workers=4, client=None):
+        self.application = app
+        self._jobs = Queue()
+        self._cookie_jar = getattr(client, 'cookie_jar', None)
+        self._threads = [Thread(target=self._work) for _ in xrange(workers)]
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def _work(self):
+        app = self.application
+        cls = getattr(app, 'test_client_class', None) or FlaskClient
+        context = app.test_request_context()
+        try:
+            context.push()
+        except Exception:
+            self._fail(sys.exc_info())
+            return
+        try:
+            try:
+                client = cls(app, TestResponse)
+            except Exception:
+                self._fail(sys.exc_info())
+                return
+            if self._cookie_jar is not None:
+                client.cookie_jar = self._cookie_jar
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                future, args, kwargs = job
+                try:
+                    future.set_result(client.open(*args, **kwargs))
+                except Exception:
+                    future.set_exception(sys.exc_info())
+        finally:
+            context.pop()
+
+    def _fail(self, exc_info):
+        """Fail the requests this thread takes with the error that kept it
+        from setting up, rather than leave them waiting."""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            job[0].set_exception(exc_info)
+
+    def open(self, *args, **kwargs):
+        """Queue a request, taking the arguments of
+        :meth:`~werkzeug.test.Client.open`."""
+        future = Future()
+        self._jobs.put((future, args, kwargs))
+        return future
+
+    def get(self, *args, **kwargs):
+        kwargs['method'] = 'GET'
+        return self.open(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        kwargs['method'] = 'POST'
+        return self.open(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        kwargs['method'] = 'PUT'
+        return self.open(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        kwargs['method'] = 'DELETE'
+        return self.open(*args, **kwargs)
+
+    def head(self, *args, **kwargs):
+        kwargs['method'] = 'HEAD'
+        return self.open(*args, **kwargs)
+
+    def close(self):
+        """Wait for the queued requests and stop the threads."""
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class Future(object):
+    """The eventual response to a request of a :class:`ConcurrentClient`."""
+
+    def __init__(self):
+        self._done = Event()
+        self._response = self.exc_info = None
+
+    def set_result(self, response):
+        self._response = response
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        """Check if the request has completed."""
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the response and return it, raising any exception the
+        request raised; its :func:`~sys.exc_info` is kept as `exc_info`.
+        Raises :exc:`RuntimeError` if `timeout` seconds pass first."""
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise RuntimeError('request timed out')
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self._response
+
+
+#: Default block size for the streaming methods of :class:`TestResponse`.
+CHUNK_SIZE = 64 * 1024
+
+#: Default number of characters a :class:`ResponseDiff` gives at most.
+DIFF_LIMIT = 4096
+
+#: Streamed bodies up to this many bytes are kept when a comparison or a
+#: diff reads them, so that they can be read again.
+BUFFER_LIMIT = 1 << 20
+
+
 class TestResponse(Response):
     """A :class:`~flask.Response` adapted to testing, this is returned by
     the test client. The added feature is that it can be compared against
-    other response objects."""
+    other response objects.
+
+    Comparisons check the cheap things first: the status code, then the
+    length of the body if both are in memory, then the headers in order,
+    and last the bodies, block by block in step, stopping at the first
+    difference. The `Content-Length` is left out, like
+    :meth:`~werkzeug.BaseResponse.freeze` would set it from the body. The
+    normalized headers are cached on both responses until they change.
+
+    A streamed body is kept as it's compared, unless it grows beyond
+    :data:`BUFFER_LIMIT` bytes; a larger one is read only once, after which
+    comparing it again raises :exc:`ValueError`.
+
+    When a comparison fails, the representation of the response shows a
+    :class:`ResponseDiff` against the other one, so passing the response
+    as the message of an assertion reports what changed::
+
+        assert response == jsonify(status='Success!'), response
+
+    For large bodies there are also methods that check the body while
+    reading it block by block, keeping memory use bounded."""
 
     def __eq__(self, other):
-        self.freeze()
-        other.freeze()
-        other.headers[:] = other.get_wsgi_headers(request.environ)
-        return all(getattr(self, name) == getattr(other, name)
-                   for name in ('status_code', 'headers', 'data'))
+        equal = self._equals(other)
+        # the diff is only worked out if the response is shown
+        self._attest_mismatch = None
+        self._attest_expected = None if equal else (other, request.environ)
+        return equal
+
+    def _equals(self, other):
+        if self.status_code != other.status_code:
+            return False
+        if self.is_sequence and other.is_sequence and \
+                _body_length(self) != _body_length(other):
+            return False
+        if _header_list(self) != _header_list(other, request.environ):
+            return False
+        return _same_body(self, other)
 
     def __ne__(self, other):
         return not self == other
 
+    def __repr__(self):
+        text = Response.__repr__(self)
+        mismatch = self._mismatch()
+        if mismatch is not None:
+            text = '%s\n%s' % (text, mismatch)
+        return text
+
+    def _mismatch(self):
+        """The :class:`ResponseDiff` against what the response last failed
+        to compare equal to, if anything."""
+        expected = getattr(self, '_attest_expected', None)
+        if expected is None:
+            return None
+        if self._attest_mismatch is None:
+            other, environ = expected
+            self._attest_mismatch = ResponseDiff(self, other, environ=environ)
+        return self._attest_mismatch
+
+    def diff(self, other, limit=DIFF_LIMIT):
+        """A :class:`ResponseDiff` of this response against the expected
+        `other` one, with at most `limit` characters of output."""
+        return ResponseDiff(self, other, limit)
+
+    def iter_chunks(self, size=CHUNK_SIZE):
+        """Iterate over the body in blocks of `size` bytes, the last block
+        possibly being shorter. Only one block is held in memory at a time,
+        but note that a streamed body can't be read again afterwards."""
+        return _iter_chunks(self, size)
+
+    def iter_lines(self, size=CHUNK_SIZE):
+        """Iterate over the lines of the body without their line endings,
+        reading it in blocks of `size` bytes."""
+        return _iter_lines(self, size)
+
+    def contains(self, text, size=CHUNK_SIZE):
+        """Check if the body contains `text`, reading it in blocks of `size`
+        bytes. ::
+
+            @get('/export.csv')
+            def export(response):
+                assert response.contains('total,1024')
+
+        """
+        overlap = len(text) - 1
+        tail = ''
+        for block in self.iter_chunks(size):
+            window = tail + block
+            if text in window:
+                return True
+            tail = window[-overlap:] if overlap else ''
+        return not text
+
+    def search(self, pattern, size=CHUNK_SIZE, overlap=1024):
+        """Search the body for a regular expression, reading it in blocks
+        of `size` bytes. Returns the match object or :const:`None`; offsets
+        in the match are relative to the window that was searched. Matches
+        longer than `overlap` bytes may be missed where they span two
+        blocks."""
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        tail = ''
+        for block in self.iter_chunks(size):
+            window = tail + block
+            match = pattern.search(window)
+            if match is not None:
+                return match
+            tail = window[-overlap:]
+        return None
+
+    def digest(self, name='sha1', size=CHUNK_SIZE):
+        """The hexadecimal digest of the body with the :mod:`hashlib`
+        algorithm `name`, reading the body in blocks of `size` bytes."""
+        digest = hashlib.new(name)
+        for block in self.iter_chunks(size):
+            digest.update(block)
+        return digest.hexdigest()
+
+
+def _iter_chunks(response, size):
+    return _rechunk(response.iter_encoded(), size)
+
+
+def _rechunk(chunks, size):
+    pending, buffered = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            block = ''.join(pending)
+            for offset in xrange(0, len(block) - size + 1, size):
+                yield block[offset:offset + size]
+            rest = block[offset + size:]
+            pending, buffered = [rest], len(rest)
+    if buffered:
+        yield ''.join(pending)
+
+
+def _iter_lines(response, size):
+    return _split_lines(_iter_chunks(response, size))
+
+
+def _split_lines(blocks):
+    rest = ''
+    for block in blocks:
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if rest:
+        yield rest.rstrip('\r')
+
+
+class ResponseDiff(object):
+    """What differs between a `response` and the `expected` one: the
+    status, the headers and the body. The status and headers are compared
+    right away, the expected headers as they would be sent in `environ`,
+    by default that of the current request; the body only once the diff is
+    turned into a string, which gives at most `limit` characters.
+
+    JSON bodies of up to `tree_limit` bytes are compared as trees, listing
+    the paths of values that differ. Other text is compared line by line,
+    streaming both bodies and matching up at most `window` lines at a
+    time, so time is linear and memory bounded whatever their size. For
+    binary bodies only the offset of the first differing byte is given.
+    Streamed bodies are kept as they're read, up to :data:`BUFFER_LIMIT`
+    bytes. ::
+
+        diff = response.diff(expected)
+        assert not diff.status, diff
+        print(diff)
+
+    """
+
+    #: Mimetypes besides ``text/*`` that are diffed line by line.
+    text_mimetypes = ('application/json', 'application/javascript',
+                      'application/xml', 'application/xhtml+xml')
+
+    def __init__(self, response, expected, limit=DIFF_LIMIT,
+                 tree_limit=1 << 20, window=200, environ=None):
+        self.response, self.expected = response, expected
+        self.limit, self.tree_limit, self.window = limit, tree_limit, window
+        #: The statuses of the response and the expected one, or
+        #: :const:`None` if they are the same.
+        self.status = None
+        if response.status_code != expected.status_code:
+            self.status = response.status, expected.status
+        if environ is None and request:
+            environ = request.environ
+        got = _header_list(response)
+        wanted = _header_list(expected, environ)
+        missing, unexpected = list(wanted), []
+        for header in got:
+            if header in missing:
+                missing.remove(header)
+            else:
+                unexpected.append(header)
+        #: Headers only the expected response has, as sorted pairs. The
+        #: `Content-Length` is left out, the lengths are given with the
+        #: body diff.
+        self.missing = sorted(missing)
+        #: Headers only the response has, as sorted pairs.
+        self.unexpected = sorted(unexpected)
+        #: Whether the headers are the same but in another order.
+        self.reordered = not missing and not unexpected and got != wanted
+        self._body = None
+
+    @property
+    def body(self):
+        """The lines of the body diff, or an empty list if the bodies are
+        the same."""
+        if self._body is None:
+            self._body = list(_truncate(self._iter_body(), self.limit))
+        return self._body
+
+    def _iter_body(self):
+        response, expected = self.response, self.expected
+        if getattr(response, '_attest_consumed', False) or \
+                getattr(expected, '_attest_consumed', False):
+            return iter(['streamed body over %d bytes, already read'
+                         % BUFFER_LIMIT])
+        if (response.mimetype == expected.mimetype == 'application/json'
+                and _kept(response) and _kept(expected)
+                and max(_body_length(response),
+                        _body_length(expected)) <= self.tree_limit):
+            try:
+                got = json.loads(''.join(response.iter_encoded()))
+                wanted = json.loads(''.join(expected.iter_encoded()))
+            except ValueError:
+                pass
+            else:
+                return _diff_trees(got, wanted, '$')
+        if self._is_text(response) and self._is_text(expected):
+            return _diff_lines(_split_lines(_rechunk(_keep(response),
+                                                     CHUNK_SIZE)),
+                               _split_lines(_rechunk(_keep(expected),
+                                                     CHUNK_SIZE)),
+                               self.window)
+        return _diff_bytes(response, expected)
+
+    def _is_text(self, response):
+        mimetype = response.mimetype or ''
+        return mimetype.startswith('text/') or \
+            mimetype in self.text_mimetypes
+
+    def __nonzero__(self):
+        return bool(self.status or self.missing or self.unexpected or
+                    self.reordered or self.body)
+
+    def __str__(self):
+        lines = []
+        if self.status:
+            lines.append('status: %s, expected %s' % self.status)
+        if self.missing or self.unexpected:
+            lines.append('headers:')
+            lines.extend('- %s: %s' % header for header in self.missing)
+            lines.extend('+ %s: %s' % header for header in self.unexpected)
+        elif self.reordered:
+            lines.append('headers: the same, in another order')
+        if self.body:
+            response, expected = self.response, self.expected
+            if response.is_sequence and expected.is_sequence:
+                lines.append('body (%d bytes, expected %d):'
+                             % (_body_length(response),
+                                _body_length(expected)))
+            else:
+                lines.append('body:')
+            lines.extend(self.body)
+        if not lines:
+            return 'no differences'
+        return '\n'.join(_truncate(lines, self.limit))
+
+
+def _truncate(lines, limit):
+    """Pass on `lines` until they add up to `limit` characters."""
+    for line in lines:
+        if len(line) > limit:
+            if limit > 0:
+                yield line[:limit]
+            yield '... (diff truncated)'
+            return
+        limit -= len(line) + 1
+        yield line
+
+
+def _diff_lines(got, wanted, window):
+    """Diff two iterators of lines, matching up `window` lines of each at
+    a time with :class:`~difflib.SequenceMatcher`. Lines after the last
+    match in a window are carried over to the next, to be matched against
+    what follows."""
+    got, wanted = iter(got), iter(wanted)
+    a, b = [], []
+    offsets = [0, 0]
+    while True:
+        a.extend(islice(got, window - len(a)))
+        b.extend(islice(wanted, window - len(b)))
+        if not a and not b:
+            return
+        common = 0
+        for line, other in zip(a, b):
+            if line != other:
+                break
+            common += 1
+        if common:
+            del a[:common], b[:common]
+            offsets[0] += common
+            offsets[1] += common
+            continue
+        opcodes = SequenceMatcher(None, a, b).get_opcodes()
+        while len(opcodes) > 1 and opcodes[-1][0] != 'equal':
+            opcodes.pop()
+        if opcodes[-1][0] != 'equal':
+            opcodes = [('replace', 0, len(a), 0, len(b))]
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                continue
+            yield '@@ line %d, expected line %d @@' % (offsets[0] + i1 + 1,
+                                                        offsets[1] + j1 + 1)
+            for line in b[j1:j2]:
+                yield '-' + line
+            for line in a[i1:i2]:
+                yield '+' + line
+        end = opcodes[-1]
+        del a[:end[2]], b[:end[4]]
+        offsets[0] += end[2]
+        offsets[1] += end[4]
+
+
+def _diff_trees(got, wanted, path):
+    """Diff two decoded JSON documents, yielding a line for every path
+    where they differ."""
+    if isinstance(got, dict) and isinstance(wanted, dict):
+        for key in sorted(set(got) | set(wanted)):
+            child = '%s.%s' % (path, key)
+            if key not in got:
+                yield '- %s: %s' % (child, json.dumps(wanted[key]))
+            elif key not in wanted:
+                yield '+ %s: %s' % (child, json.dumps(got[key]))
+            else:
+                for line in _diff_trees(got[key], wanted[key], child):
+                    yield line
+    elif isinstance(got, list) and isinstance(wanted, list):
+        for index in xrange(max(len(got), len(wanted))):
+            child = '%s[%d]' % (path, index)
+            if index >= len(got):
+                yield '- %s: %s' % (child, json.dumps(wanted[index]))
+            elif index >= len(wanted):
+                yield '+ %s: %s' % (child, json.dumps(got[index]))
+            else:
+                for line in _diff_trees(got[index], wanted[index], child):
+                    yield line
+    elif got != wanted or type(got) is not type(wanted):
+        yield '%s: %s, expected %s' % (path, json.dumps(got),
+                                       json.dumps(wanted))
+
+
+def _diff_bytes(response, expected):
+    offset = 0
+    chunks = _rechunk(_keep(expected), CHUNK_SIZE)
+    for block in _rechunk(_keep(response), CHUNK_SIZE):
+        try:
+            other = chunks.next()
+        except StopIteration:
+            other = ''
+        if block != other:
+            for index, (byte, wanted) in enumerate(zip(block, other)):
+                if byte != wanted:
+                    break
+            else:
+                index = min(len(block), len(other))
+            yield 'bodies differ from byte %d' % (offset + index)
+            return
+        offset += len(block)
+    try:
+        chunks.next()
+    except StopIteration:
+        return
+    yield 'bodies differ from byte %d' % offset
+
+
+def _body_length(response):
+    """Length of a body that is in memory."""
+    return sum(len(chunk) for chunk in response.iter_encoded())
+
+
+def _keep(response):
+    """Iterate over the encoded body of a response. A streamed body is kept
+    as it's read, and also if reading stops early, so that it can be read
+    again, unless it grows beyond :data:`BUFFER_LIMIT` bytes."""
+    if getattr(response, '_attest_consumed', False):
+        raise ValueError('the streamed body of %r was larger than '
+                         'BUFFER_LIMIT and has already been read'
+                         % (response,))
+    chunks = response.iter_encoded()
+    if response.is_sequence:
+        for chunk in chunks:
+            yield chunk
+        return
+    kept, size = [], 0
+    try:
+        for chunk in chunks:
+            if kept is not None:
+                kept.append(chunk)
+                size += len(chunk)
+                if size > BUFFER_LIMIT:
+                    kept = None
+            yield chunk
+    finally:
+        if kept is not None:
+            for chunk in chunks:
+                kept.append(chunk)
+                size += len(chunk)
+                if size > BUFFER_LIMIT:
+                    kept = None
+                    break
+        if kept is None:
+            response._attest_consumed = True
+        else:
+            # like make_sequence
+            close = getattr(response.response, 'close', None)
+            response.response = kept
+            if close is not None:
+                response.call_on_close(close)
+
+
+def _kept(response):
+    """Read a streamed body into memory if it's within
+    :data:`BUFFER_LIMIT` bytes, returning whether the body is in memory."""
+    if not response.is_sequence:
+        for chunk in _keep(response):
+            pass
+    return response.is_sequence
+
+
+def _same_body(response, other):
+    """Compare two bodies block by block, stopping at the first
+    difference."""
+    got, wanted = _keep(response), _keep(other)
+    blocks = _rechunk(got, CHUNK_SIZE)
+    others = _rechunk(wanted, CHUNK_SIZE)
+    try:
+        for block in blocks:
+            try:
+                if block != others.next():
+                    return False
+            except StopIteration:
+                return False
+        try:
+            others.next()
+        except StopIteration:
+            return True
+        return False
+    finally:
+        blocks.close()
+        others.close()
+        got.close()
+        wanted.close()
+
+
+def _header_list(response, environ=None):
+    """The headers of a response in order, as they were when it was sent,
+    or as they would be if it was sent in `environ`. The `Content-Length`
+    is left out. Cached for as long as the headers are unchanged."""
+    key = tuple(response.headers)
+    cached = getattr(response, '_attest_headers', None)
+    if cached is not None and cached[0] == key and cached[1] is environ:
+        return cached[2]
+    headers = key
+    if environ is not None:
+        headers = tuple(response.get_wsgi_headers(environ))
+    headers = tuple(header for header in headers
+                    if header[0].lower() != 'content-length')
+    response._attest_headers = key, environ, headers
+    return headers
+
+def run_parallel(tests, processes=None, reporter=auto_reporter,
+                 failfast=False):
+    """Run a test collection like :meth:`~attest.collectors.Tests.run`,
+    spread across a pool of `processes` worker processes, defaulting to
+    the number of CPUs. Results are merged into the one `reporter`. Tests
+    are handed out in order, so an order from :meth:`History.schedule`
+    is kept as far as the workers allow.
+
+    Workers are forked from the current process, so each builds its own
+    application through the factory of a process-scoped
+    :func:`request_context` and runs its share of the tests with it.
+    Contexts that create temporary resources per test stay isolated the
+    same way they are in a serial run. A worker that dies fails the test
+    it was running and is replaced. Requires :func:`os.fork`.
+
+    With `failfast` the workers are stopped as soon as a failure is
+    reported, without finishing the tests they were running or tearing
+    down their applications, and the run finishes with the results so
+    far.
+
+    """
+    tests = list(tests)
+    if processes is None:
+        processes = _cpu_count()
+    assertions, statistics.assertions = statistics.assertions, 0
+    if not isinstance(reporter, AbstractReporter):
+        reporter = reporter()
+    reporter.begin(tests)
+    workers = []
+    queued = iter(xrange(len(tests)))
+    try:
+        try:
+            for index in islice(queued, processes):
+                worker = _Worker(tests, workers)
+                workers.append(worker)
+                worker.send(index)
+            busy = list(workers)
+            while busy:
+                for worker in select.select(busy, [], [])[0]:
+                    received = worker.receive()
+                    if received is None:
+                        index = worker.index
+                        result, count = _exited(worker.close()), 0
+                    else:
+                        index, result, count = received
+                    result.test = tests[index]
+                    statistics.assertions += count
+                    _report(reporter, result)
+                    if failfast and result.error is not None:
+                        busy = []
+                        break
+                    if received is None:
+                        busy.remove(worker)
+                    for index in islice(queued, 1):
+                        if received is None:
+                            worker = _Worker(tests, workers)
+                            workers.append(worker)
+                            busy.append(worker)
+                        worker.send(index)
+                        break
+                    else:
+                        if received is not None:
+                            busy.remove(worker)
+                            worker.close()
+        except KeyboardInterrupt:
+            pass
+        for worker in workers:
+            worker.close(kill=True)
+        reporter.finished()
+    finally:
+        statistics.assertions = assertions
+
+
+def _cpu_count():
+    try:
+        return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+class _Worker(object):
+    """A child process of :func:`run_parallel`, running the tests it's sent
+    the indices of one at a time and sending back their results."""
+
+    def __init__(self, tests, others):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        tasks, self._tasks = os.pipe()
+        results, written = os.pipe()
+        self.pid = os.fork()
+        if not self.pid:
+            os.close(self._tasks)
+            os.close(results)
+            # or the other workers wouldn't see the end of their tasks
+            for other in others:
+                other.close(child=True)
+            _worker_loop(tests, tasks, written)
+        os.close(tasks)
+        os.close(written)
+        self.results = os.fdopen(results, 'rb')
+        self.index = self.status = None
+
+    def fileno(self):
+        return self.results.fileno()
+
+    def send(self, index):
+        self.index = index
+        try:
+            os.write(self._tasks, '%d\n' % index)
+        except OSError:
+            # the worker died, which receiving will find out
+            pass
+
+    def receive(self):
+        """The next result, or :const:`None` if the worker died first."""
+        try:
+            return pickle.load(self.results)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+
+    def close(self, kill=False, child=False):
+        """Tell the worker there's nothing more to do and wait for it to
+        exit, returning its status. With `kill` it's killed instead."""
+        if self._tasks is not None:
+            os.close(self._tasks)
+            self._tasks = None
+        if child:
+            self.results.close()
+            return None
+        if self.pid is not None:
+            if kill:
+                try:
+                    os.kill(self.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            self.status = os.waitpid(self.pid, 0)[1]
+            self.pid = None
+            self.results.close()
+        return self.status
+
+
+def _worker_loop(tests, tasks, results):
+    status = 1
+    try:
+        tasks = os.fdopen(tasks, 'rb')
+        results = os.fdopen(results, 'wb')
+        for line in iter(tasks.readline, ''):
+            index = int(line)
+            before = statistics.assertions
+            result = RemoteResult(_execute(tests[index]))
+            pickle.dump((index, result, statistics.assertions - before),
+                        results, pickle.HIGHEST_PROTOCOL)
+            results.flush()
+        _shutdown_scoped()
+        status = 0
+    except BaseException:
+        traceback.print_exc()
+    os._exit(status)
+
+
+def _execute(test):
+    """Run a single test the way Attest does, returning its
+    :class:`~attest.reporters.TestResult`."""
+    result = TestResult()
+    result.test = test
+    started = time.time()
+    try:
+        with capture_output() as (out, err):
+            if test() is False:
+                raise AssertionError('test() is False')
+    except KeyboardInterrupt:
+        raise
+    except BaseException:
+        result.error = sys.exc_info()[1]
+        result.exc_info = sys.exc_info()
+    result.duration = time.time() - started
+    result.stdout, result.stderr = out, err
+    return result
+
+
+def run_serial(tests, reporter=auto_reporter, failfast=False):
+    """Run a test collection like :meth:`~attest.collectors.Tests.run`
+    does, in the order of `tests`, stopping at the first failure with
+    `failfast`. Results have a `duration`, for :class:`History`. ::
+
+        history = History('.attest-history.json')
+        run_serial(history.schedule(all), history.reporter(), failfast=True)
+
+    """
+    tests = list(tests)
+    assertions, statistics.assertions = statistics.assertions, 0
+    if not isinstance(reporter, AbstractReporter):
+        reporter = reporter()
+    reporter.begin(tests)
+    try:
+        for test in tests:
+            try:
+                result = _execute(test)
+            except KeyboardInterrupt:
+                break
+            _report(reporter, result)
+            if failfast and result.error is not None:
+                break
+        reporter.finished()
+    finally:
+        statistics.assertions = assertions
+
+
+def run_forked(tests, reporter=auto_reporter, contexts=None, batch=1,
+               failfast=False):
+    """Run a test collection like :func:`run_serial`, but with each test,
+    or each `batch` of tests, in a child process forked from this one.
+    Anything the tests change, such as module globals or the application,
+    is thrown away with the child, while the children share the memory
+    of this process until they write to it.
+
+    First the applications of the process-scoped `contexts` are built
+    and warmed up, by building their URL maps and compiling all their
+    templates, so that the children start out with that done. By default
+    that's every process-scoped :func:`request_context` there is. ::
+
+        run_forked(all, contexts=[testapp])
+
+    A child that dies without reporting fails the test it was running.
+    Like with :func:`run_parallel`, what instruments record in the child,
+    such as a :class:`Profiler`, is lost with it. Requires
+    :func:`os.fork`.
+
+    """
+    tests = list(tests)
+    if contexts is None:
+        contexts = _warmers.keys()
+    for context in contexts:
+        context.warm()
+    assertions, statistics.assertions = statistics.assertions, 0
+    if not isinstance(reporter, AbstractReporter):
+        reporter = reporter()
+    reporter.begin(tests)
+    try:
+        failed = False
+        for start in xrange(0, len(tests), batch):
+            results = _run_child(tests, range(start, min(start + batch,
+                                                         len(tests))))
+            try:
+                for index, result, count in results:
+                    result.test = tests[index]
+                    statistics.assertions += count
+                    _report(reporter, result)
+                    if failfast and result.error is not None:
+                        failed = True
+                        break
+            finally:
+                results.close()
+            if failed:
+                break
+        reporter.finished()
+    finally:
+        statistics.assertions = assertions
+
+
+def _run_child(tests, indices):
+    """Fork a child to run the tests at `indices`, yielding their results
+    as the child sends them. Closing the generator kills the child."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        _child(tests, indices, write)
+    os.close(write)
+    pending = list(indices)
+    f = os.fdopen(read, 'rb')
+    try:
+        while pending:
+            try:
+                index, result, count = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                break
+            pending.remove(index)
+            yield index, result, count
+        if pending:
+            status = os.waitpid(pid, 0)[1]
+            pid = None
+            for index in pending:
+                yield index, _exited(status), 0
+    finally:
+        f.close()
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+
+
+def _child(tests, indices, fd):
+    status = 1
+    try:
+        f = os.fdopen(fd, 'wb')
+        for index in indices:
+            before = statistics.assertions
+            result = RemoteResult(_execute(tests[index]))
+            pickle.dump((index, result, statistics.assertions - before), f,
+                        pickle.HIGHEST_PROTOCOL)
+            f.flush()
+        f.close()
+        status = 0
+    except BaseException:
+        traceback.print_exc()
+    os._exit(status)
+
+
+def _exited(status):
+    if os.WIFSIGNALED(status):
+        message = 'test process killed by signal %d' % os.WTERMSIG(status)
+    else:
+        message = 'test process exited with status %d' % \
+            os.WEXITSTATUS(status)
+    return _error_result(message)
+
+
+def _error_result(message):
+    """A failed result for a test that couldn't report one itself."""
+    result = TestResult()
+    result.error = RuntimeError(message)
+    result.exc_info = type(result.error), result.error, None
+    result.stdout, result.stderr = [], []
+    return result
+
+
+def _report(reporter, result):
+    if result.error is None:
+        reporter.success(result)
+    else:
+        reporter.failure(result)
+
+
+class RemoteResult(TestResult):
+    """A picklable copy of a :class:`~attest.reporters.TestResult`, for
+    results that cross process boundaries. The traceback is kept as
+    extracted and formatted text, and the test itself is left out and
+    needs to be filled back in by the receiving side."""
+
+    def __init__(self, result):
+        self.stdout, self.stderr = result.stdout, result.stderr
+        self.duration = getattr(result, 'duration', None)
+        if result.error is not None:
+            self._raw_traceback = result.raw_traceback
+            self._traceback = result.traceback
+            self._assertion = result.assertion
+            self.error = _picklable(result.error)
+            self.exc_info = (type(self.error), self.error, None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('test', None)
+        return state
+
+    raw_traceback = property(lambda self: self._raw_traceback)
+    traceback = property(lambda self: self._traceback)
+    assertion = property(lambda self: self._assertion)
+
+
+def _picklable(error):
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        if isinstance(error, AssertionError):
+            return AssertionError(str(error))
+        return Exception('%s: %s' % (type(error).__name__, error))
+    return error
+
+
+class History(object):
+    """Durations and failures of tests in previous runs, persisted as JSON
+    at `path`, for splitting a suite into shards that take about as long
+    to run and for running the tests most likely to fail first. The
+    latest `keep` runs of each test are kept. Record a run with a reporter
+    wrapped by :meth:`reporter`, or by passing the history to
+    :func:`merge_shards`.
+
+    """
+
+    def __init__(self, path, keep=5):
+        self.path = path
+        self.keep = keep
+        #: Mapping of test names to dicts with lists of ``'durations'`` in
+        #: seconds and ``'failures'`` as booleans, the latest last.
+        self.tests = {}
+        if os.path.exists(path):
+            f = __builtin__.open(path)
+            try:
+                self.tests = json.load(f)
+            finally:
+                f.close()
+
+    def save(self):
+        f = __builtin__.open(self.path, 'w')
+        try:
+            json.dump(self.tests, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    def record(self, name, duration, failed=False):
+        """Add a `duration` of the test `name`, and whether it `failed`."""
+        test = self.tests.setdefault(name, {})
+        for key, value in (('durations', duration), ('failures', failed)):
+            values = test.setdefault(key, [])
+            values.append(value)
+            del values[:-self.keep]
+
+    def failure_rate(self, name):
+        """The fraction of the kept runs of the test `name` that failed."""
+        failures = self.tests.get(name, {}).get('failures')
+        if not failures:
+            return 0.0
+        return float(sum(failures)) / len(failures)
+
+    def failed_last(self, name):
+        """Check if the test `name` failed the last time it ran."""
+        failures = self.tests.get(name, {}).get('failures')
+        return bool(failures and failures[-1])
+
+    def schedule(self, tests):
+        """Order `tests` to fail as early as possible: first those that
+        failed last time, then by how often they failed, then the slowest
+        first so that they don't hold up the end of a parallel run. Tests
+        without history keep their order after those that failed."""
+        tests = list(tests)
+        names = [_test_name(test) for test in tests]
+
+        def key(index):
+            name = names[index]
+            return (not self.failed_last(name), -self.failure_rate(name),
+                    -self.duration(name, 0.0), index)
+        return [tests[index] for index in sorted(xrange(len(tests)),
+                                                 key=key)]
+
+    def duration(self, name, default=None):
+        """The average duration of the test `name`, or `default` if it
+        hasn't run before."""
+        durations = self.tests.get(name, {}).get('durations')
+        if not durations:
+            return default
+        return sum(durations) / len(durations)
+
+    def shards(self, tests, count):
+        """Split `tests` into `count` lists of about the same total
+        duration, by longest processing time first: the slowest test goes
+        to the shard with the least work so far, and so on. Tests that
+        haven't run before count as taking the median time. The split is
+        deterministic, and each shard keeps the order of the suite."""
+        tests = list(tests)
+        return _split(tests, [self.duration(_test_name(test))
+                              for test in tests], count)
+
+    def reporter(self, reporter=auto_reporter):
+        """Wrap a reporter to record how long the tests take, saving the
+        history when the run finishes. Results without a duration of
+        their own are timed from the previous result."""
+        return _TimingReporter(self, reporter)
+
+
+def _split(tests, durations, count):
+    known = sorted(duration for duration in durations
+                   if duration is not None)
+    median = known[len(known) // 2] if known else 1.0
+    durations = [median if duration is None else duration
+                 for duration in durations]
+    loads = [0.0] * count
+    shards = [[] for _ in xrange(count)]
+    for index in sorted(xrange(len(tests)),
+                        key=lambda index: (-durations[index], index)):
+        shard = loads.index(min(loads))
+        loads[shard] += durations[index]
+        shards[shard].append(index)
+    return [[tests[index] for index in sorted(shard)] for shard in shards]
+
+
+class _TimingReporter(AbstractReporter):
+
+    def __init__(self, history, reporter):
+        if not isinstance(reporter, AbstractReporter):
+            reporter = reporter()
+        self.history, self.reporter = history, reporter
+        self._last = None
+
+    def begin(self, tests):
+        self._last = time.time()
+        self.reporter.begin(tests)
+
+    def success(self, result):
+        self._record(result, False)
+        self.reporter.success(result)
+
+    def failure(self, result):
+        self._record(result, True)
+        self.reporter.failure(result)
+
+    def _record(self, result, failed):
+        now = time.time()
+        duration = getattr(result, 'duration', None)
+        if duration is None:
+            duration = now - self._last
+        self._last = now
+        self.history.record(result.test_name, duration, failed)
+
+    def finished(self):
+        self.history.save()
+        self.reporter.finished()
+
+
+def run_shard(tests, index, count, path, history=None):
+    """Run shard number `index` of `count` of a test collection, as split
+    by :meth:`History.shards`, and save the results at `path` for
+    :func:`merge_shards`. Without a `history` the tests are dealt out in
+    turn. Results are written as each test finishes, so those of a shard
+    that dies halfway are kept. Meant for running a suite on several
+    machines at once::
+
+        history = History('.attest-history.json')
+        node = int(os.environ['NODE'])
+        run_shard(suite, node, 4, 'results-%d.pickle' % node, history)
+
+    Every machine needs the same history and suite to agree on the split.
+
+    """
+    if history is None:
+        tests = list(tests)
+        shard = _split(tests, [None] * len(tests), count)[index]
+    else:
+        shard = history.shards(tests, count)[index]
+    assertions, statistics.assertions = statistics.assertions, 0
+    f = __builtin__.open(path, 'wb')
+    try:
+        for test in shard:
+            before = statistics.assertions
+            result = RemoteResult(_execute(test))
+            pickle.dump((_test_name(test), result,
+                         statistics.assertions - before),
+                        f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+    finally:
+        statistics.assertions = assertions
+        f.close()
+
+
+def merge_shards(tests, paths, reporter=auto_reporter, history=None):
+    """Report the results saved by :func:`run_shard` at `paths` through
+    the one `reporter`, as if the tests had run together. The `tests` are
+    the suite that was split up. With a `history` the durations of the
+    tests are recorded and saved for the next split. ::
+
+        merge_shards(suite, glob('results-*.pickle'), history=history)
+
+    Tests of the suite that have no result in any of the files, because
+    their shard crashed or never ran, are reported as failures. Missing
+    files are skipped.
+
+    """
+    tests = list(tests)
+    byname = dict((_test_name(test), test) for test in tests)
+    merged = []
+    for path in paths:
+        merged.extend(_load_shard(path))
+    for name, result, count in merged:
+        result.test = byname.get(name) or _NamedTest(name)
+    reported = set(name for name, result, count in merged)
+    for test in tests:
+        name = _test_name(test)
+        if name in reported:
+            continue
+        result = _error_result('no shard reported a result for this test')
+        result.test = test
+        if history is not None:
+            result.duration = history.duration(name)
+        merged.append((name, result, 0))
+    assertions, statistics.assertions = statistics.assertions, 0
+    if not isinstance(reporter, AbstractReporter):
+        reporter = reporter()
+    if history is not None:
+        reporter = history.reporter(reporter)
+    reporter.begin([result.test for name, result, count in merged])
+    try:
+        for name, result, count in merged:
+            statistics.assertions += count
+            _report(reporter, result)
+        reporter.finished()
+    finally:
+        statistics.assertions = assertions
+
+
+def _load_shard(path):
+    """Yield the results saved by :func:`run_shard` at `path`, up to where
+    the file ends or was cut off."""
+    try:
+        f = __builtin__.open(path, 'rb')
+    except IOError:
+        return
+    try:
+        while True:
+            try:
+                yield pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                return
+    finally:
+        f.close()
+
+
+class _NamedTest(object):
+    """Stands in for a test that is no longer in the suite."""
+
+    def __init__(self, name):
+        module, _, self.__name__ = name.rpartition('.')
+        self.__module__ = module or '__main__'
+
+    def __call__(self):
+        pass
+
+
+class Profiler(object):
+    """Records the cost of tests and of the requests they make. Pass it to
+    :func:`request_context` and run the suite with a reporter wrapped by
+    :meth:`reporter` to have the records named after the tests and a
+    summary of the slowest endpoints printed at the end::
+
+        profiler = Profiler()
+
+        @request_context(profiler=profiler)
+        def testapp():
+            yield create_app(__name__)
+
+        if __name__ == '__main__':
+            suite.run(profiler.reporter())
+
+    With `memory` enabled the peak memory allocated during each request is
+    measured with :mod:`tracemalloc`, which needs to be available. It's not
+    on a stock Python 2 interpreter, where enabling `memory` raises
+    :exc:`RuntimeError`. Where :func:`tracemalloc.reset_peak` is missing
+    the traces are cleared before each request instead, which also loses
+    those taken for anything else.
+
+    """
+
+    def __init__(self, memory=False):
+        if memory and tracemalloc is None:
+            raise RuntimeError('memory profiling requires tracemalloc')
+        self.memory = memory
+        #: A :class:`TestProfile` for every test that has been run.
+        self.tests = []
+        self._request = None
+        self._apps = WeakKeyDictionary()
+
+    @property
+    def current(self):
+        """The :class:`TestProfile` of the test running now, or last."""
+        return self.tests[-1] if self.tests else None
+
+    def begin(self):
+        self.tests.append(TestProfile())
+
+    def started(self):
+        profile = self.current
+        profile.setup = time.time() - profile.started
+
+    def end(self):
+        profile = self.current
+        profile.total = time.time() - profile.started
+
+    def instrument(self, client):
+        """Record every request made by a test client."""
+        app = client.application
+        if app not in self._apps:
+            request_started.connect(self._request_started, app)
+            self._apps[app] = True
+        client.open = partial(self._open, client.open)
+
+    def _request_started(self, app):
+        self._request = request.method, request.path, request.endpoint
+
+    def _open(self, open, *args, **kwargs):
+        templates = []
+        sink = lambda rendering: templates.append(rendering[0])
+        self._request = None, None, None
+        memory = None
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.clear_traces()
+            memory = tracemalloc.get_traced_memory()[0]
+        _sinks.append(sink)
+        cpu, wall = sum(os.times()[:2]), time.time()
+        try:
+            response = open(*args, **kwargs)
+        finally:
+            wall, cpu = time.time() - wall, sum(os.times()[:2]) - cpu
+            _sinks.remove(sink)
+            if memory is not None:
+                memory = tracemalloc.get_traced_memory()[1] - memory
+        method, path, endpoint = self._request
+        record = RequestProfile(method=method, path=path, endpoint=endpoint,
+                                status_code=response.status_code,
+                                wall=wall, cpu=cpu, templates=templates,
+                                size=response.content_length, memory=memory)
+        self.current.requests.append(record)
+        if record.size is None:
+            # like make_sequence, but counting instead of keeping
+            close = getattr(response.response, 'close', None)
+            response.response = _count_body(response.response, record)
+            if close is not None:
+                response.call_on_close(close)
+        return response
+
+    def slowest(self, limit=10):
+        """Summarize the requests of all tests by endpoint, returning up to
+        `limit` tuples of ``(endpoint, count, total, worst)`` with times in
+        seconds, slowest total first."""
+        summary = {}
+        for profile in self.tests:
+            for record in profile.requests:
+                count, total, worst = summary.get(record.endpoint, (0, 0, 0))
+                summary[record.endpoint] = (count + 1, total + record.wall,
+                                            max(worst, record.wall))
+        summary = [(endpoint,) + values
+                   for endpoint, values in summary.iteritems()]
+        summary.sort(key=lambda item: item[2], reverse=True)
+        return summary[:limit]
+
+    def reporter(self, reporter=auto_reporter):
+        """Wrap a reporter to name the test profiles and print a summary of
+        the slowest endpoints before the report finishes."""
+        return _ProfilingReporter(self, reporter)
+
+
+def _count_body(chunks, record):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    record.size = size
+
+
+class TestProfile(object):
+    """The cost of a single test, with times in seconds."""
+
+    def __init__(self):
+        #: Name of the test, if run with :meth:`Profiler.reporter`.
+        self.name = None
+        self.started = time.time()
+        #: Time spent in contexts before the test itself started.
+        self.setup = None
+        #: Time spent in the test including its contexts.
+        self.total = None
+        #: A :class:`RequestProfile` for every request made.
+        self.requests = []
+
+
+class RequestProfile(object):
+    """The cost of a single request. Times are in seconds, `cpu` being the
+    processor time of the whole process, and `memory` is the peak number of
+    bytes allocated, if measured. `templates` lists the names of templates
+    rendered and `size` is the length of the body. For a streamed body
+    without a `Content-Length` the size is counted as the body is read,
+    and is :const:`None` until then."""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class _ProfilingReporter(AbstractReporter):
+
+    def __init__(self, profiler, reporter):
+        if not isinstance(reporter, AbstractReporter):
+            reporter = reporter()
+        self.profiler, self.reporter = profiler, reporter
+
+    def begin(self, tests):
+        self.reporter.begin(tests)
+
+    def success(self, result):
+        self._name(result)
+        self.reporter.success(result)
+
+    def failure(self, result):
+        self._name(result)
+        self.reporter.failure(result)
+
+    def _name(self, result):
+        profile = self.profiler.current
+        if profile is not None and profile.name is None:
+            profile.name = result.test_name
+
+    def finished(self):
+        write = sys.stdout.write
+        write('\nSlowest endpoints:\n')
+        for endpoint, count, total, worst in self.profiler.slowest():
+            write('  %-40s %5d requests %8.3fs total %8.3fs worst\n'
+                  % (endpoint, count, total, worst))
+        self.reporter.finished()
+
+
+def find_leaks(context, test=None, runs=10, warmup=2, limit=10):
+    """Enter a test `context`, such as one made by :func:`request_context`,
+    `runs` times over with a `test` in it, and return a
+    :class:`LeakReport` of what was left behind. The test is called with
+    what the context yields, or it is one of the decorators returned by
+    :func:`open` and its shortcuts to make that request. Leaving out the
+    test checks the context itself. The first `warmup` runs are not
+    measured, to let caches fill up. ::
+
+        report = find_leaks(testapp, get('/timeline'), runs=50)
+        assert not report.leaking, report
+
+    After each run the garbage is collected and the live objects counted
+    by type; types of which there are more after every single run are
+    reported. So are receivers added to the signals of Flask and of this
+    extension, request contexts left pushed and template captures left
+    connected. If :mod:`tracemalloc` is available, the allocation sites
+    that grew the most are reported too, at most `limit` of them.
+
+    """
+    if test is None:
+        test = lambda *args: None
+    elif hasattr(test, 'compiled'):
+        test = test(lambda response, *args: None)
+
+    def run():
+        with context() as args:
+            if not isinstance(args, tuple):
+                args = args,
+            test(*args)
+
+    for _ in xrange(warmup):
+        run()
+    started = tracemalloc is not None and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        report = LeakReport()
+        gc.collect()
+        before = _leak_state()
+        snapshot = tracemalloc and tracemalloc.take_snapshot()
+        counts, growing = _object_counts(), None
+        for _ in xrange(runs):
+            run()
+            gc.collect()
+            previous, counts = counts, _object_counts()
+            grew = set(name for name, count in counts.iteritems()
+                       if count > previous.get(name, 0))
+            growing = grew if growing is None else growing & grew
+            report.runs += 1
+        after = _leak_state()
+        if snapshot:
+            stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+            report.allocations = [(str(stat.traceback), stat.size_diff,
+                                   stat.count_diff)
+                                  for stat in stats[:limit]
+                                  if stat.size_diff > 0]
+    finally:
+        if started:
+            tracemalloc.stop()
+    for name in growing or ():
+        report.objects[name] = counts[name] - before[0].get(name, 0)
+    for name, receivers in after[1].iteritems():
+        if receivers > before[1][name]:
+            report.receivers[name] = receivers - before[1][name]
+    report.contexts = after[2] - before[2]
+    report.captures = after[3] - before[3]
+    return report
+
+
+def _object_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def _leak_state():
+    signals = [('template_rendered', template_rendered),
+               ('flask.template_rendered', jinja_rendered),
+               ('flask.request_started', request_started),
+               ('flask.request_finished', request_finished),
+               ('flask.got_request_exception', got_request_exception)]
+    if _genshi_generated not in (None, _unresolved):
+        signals.append(('flaskext.genshi.template_generated',
+                        _genshi_generated))
+    receivers = dict((name, len(signal.receivers))
+                     for name, signal in signals)
+    contexts = len(getattr(_request_ctx_stack._local, 'stack', ()))
+    return (_object_counts(), receivers, contexts,
+            len(_sinks) + len(_loaders))
+
+
+class LeakReport(object):
+    """Results of :func:`find_leaks`. Growth is counted from after the
+    warmup runs to after the last run."""
+
+    def __init__(self):
+        #: Number of measured runs.
+        self.runs = 0
+        #: Names of the types of which there were more objects after every
+        #: run, mapped to how many more there were in all.
+        self.objects = {}
+        #: Names of signals that gained receivers, mapped to how many.
+        self.receivers = {}
+        #: Number of request contexts left pushed.
+        self.contexts = 0
+        #: Number of template captures left connected.
+        self.captures = 0
+        #: The allocation sites that grew the most, as ``(site, size,
+        #: count)`` tuples with the growth in bytes and in blocks, or
+        #: :const:`None` without :mod:`tracemalloc`.
+        self.allocations = None
+
+    @property
+    def leaking(self):
+        """Check if anything was left behind."""
+        return bool(self.objects or self.receivers or self.contexts > 0 or
+                    self.captures > 0)
+
+    def __str__(self):
+        lines = ['%d runs' % self.runs]
+        for name in sorted(self.objects, key=self.objects.get, reverse=True):
+            lines.append('%s objects: +%d' % (name, self.objects[name]))
+        for name in sorted(self.receivers):
+            lines.append('%s receivers: +%d' % (name, self.receivers[name]))
+        if self.contexts > 0:
+            lines.append('request contexts: +%d' % self.contexts)
+        if self.captures > 0:
+            lines.append('template captures: +%d' % self.captures)
+        for site, size, count in self.allocations or ():
+            lines.append('%s: +%d bytes in %d blocks' % (site, size, count))
+        return '\n'.join(lines)
+
+
+class Recorder(object):
+    """Records the requests made by test clients, and the responses to
+    them, to a corpus file at `path` for :func:`replay`. The corpus has one
+    JSON record per line and is compressed with gzip if the path ends with
+    ``.gz``. Redirects that are followed are recorded as separate
+    requests. Responses are buffered to record them.
+
+    ::
+
+        recorder = Recorder('corpus.json.gz')
+
+        @request_context(recorder=recorder)
+        def testapp():
+            yield create_app(__name__)
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._apps = WeakKeyDictionary()
+        _scoped[self] = 'close'
+
+    def instrument(self, client):
+        """Record every request made by a test client."""
+        app = client.application
+        if app not in self._apps:
+            app.wsgi_app = partial(self._record, app.wsgi_app)
+            self._apps[app] = True
+
+    def _record(self, wsgi_app, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        data = environ['wsgi.input'].read(length)
+        environ['wsgi.input'] = StringIO(data)
+        sent = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            sent[:] = status, headers
+            return start_response(status, headers, exc_info)
+
+        app_iter = wsgi_app(environ, recording_start_response)
+        try:
+            body = list(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        self.write({
+            'method': environ['REQUEST_METHOD'],
+            'path': environ.get('PATH_INFO', '/'),
+            'query_string': environ.get('QUERY_STRING', ''),
+            'content_type': environ.get('CONTENT_TYPE'),
+            'headers': [(key[5:].replace('_', '-').title(), value)
+                        for key, value in environ.iteritems()
+                        if key.startswith('HTTP_')],
+            'data': b64encode(data),
+            'status': sent[0],
+            'response_headers': sent[1],
+            'response': b64encode(''.join(body)),
+        })
+        return body
+
+    def write(self, record):
+        """Append a record to the corpus."""
+        if self._file is None:
+            if self.path.endswith('.gz'):
+                self._file = GzipFile(self.path, 'ab')
+            else:
+                self._file = __builtin__.open(self.path, 'ab')
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def close(self):
+        """Close the corpus file, if open."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_corpus(path):
+    """Iterate over the records of a corpus written by :class:`Recorder`,
+    reading one line at a time."""
+    if path.endswith('.gz'):
+        f = GzipFile(path, 'rb')
+    else:
+        f = __builtin__.open(path, 'rb')
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        f.close()
+
+
+def replay(corpus, app, batch_size=1000):
+    """Issue the requests recorded in a `corpus` against `app` and compare
+    the responses with the recorded ones, like :class:`TestResponse`
+    does. Yields a :class:`Mismatch` for every response that differs.
+    The corpus is read as a stream and replayed in batches of `batch_size`
+    requests, each batch with one test request context and client. The
+    recorded cookies are sent as they were, rather than through the
+    cookie handling of the client."""
+    records = iter_corpus(corpus)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        with app.test_request_context():
+            cls = getattr(app, 'test_client_class', None) or FlaskClient
+            client = cls(app, TestResponse, use_cookies=False)
+            for record in batch:
+                response = client.open(
+                    record['path'], method=record['method'],
+                    query_string=record['query_string'],
+                    headers=[tuple(header) for header in record['headers']],
+                    content_type=record['content_type'],
+                    data=b64decode(record['data']))
+                expected = Response(b64decode(record['response']),
+                                    record['status'],
+                                    [tuple(header) for header
+                                     in record['response_headers']])
+                if response != expected:
+                    yield Mismatch(record, response, expected)
+
+
+class Mismatch(object):
+    """A response from :func:`replay` that differs from the recording."""
+
+    def __init__(self, record, response, expected):
+        #: The record from the corpus.
+        self.record = record
+        #: The new :class:`TestResponse`.
+        self.response = response
+        #: The recorded response.
+        self.expected = expected
+
+
+class DependencyIndex(object):
+    """Index of the endpoints, view modules and templates each test uses,
+    persisted as JSON at `path`, for running only the tests affected by a
+    change. Build or update the index by running the suite with a reporter
+    wrapped by :meth:`reporter`, then select tests with :meth:`select`::
+
+        index = DependencyIndex('.attest-index.json')
+        changed = sys.argv[1:]
+        Tests([index.select(suite, changed)]).run(index.reporter())
+
+    Tests that aren't in the index yet are always selected, as are tests
+    in changed test modules. Templates count as used by a test when they
+    were loaded during it, including those extended, included or
+    imported by the rendered ones. A changed file the index knows nothing
+    about, such as a model, a helper module, a database schema or a
+    template no test loaded, could affect any test, and selects them all.
+    The index is recorded from a serial run; it doesn't see into the
+    workers of :func:`run_parallel`.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        #: Mapping of test names to dicts with the lists ``'endpoints'``,
+        #: ``'modules'`` and ``'templates'``.
+        self.tests = {}
+        if os.path.exists(path):
+            f = __builtin__.open(path)
+            try:
+                self.tests = json.load(f)
+            finally:
+                f.close()
+        self._current = None
+
+    def save(self):
+        f = __builtin__.open(self.path, 'w')
+        try:
+            json.dump(self.tests, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    def select(self, tests, changed):
+        """Return the tests affected by the `changed` file paths. A file
+        that no indexed test is known to use, template or not, affects
+        all."""
+        own = os.path.abspath(self.path)
+        changed = [os.path.abspath(path) for path in changed]
+        changed = [path for path in changed if path != own]
+        tests = list(tests)
+        modules = set(_test_file(test) for test in tests)
+        templates = set()
+        for uses in self.tests.itervalues():
+            modules.update(uses['modules'])
+            templates.update(uses['templates'])
+        for path in changed:
+            if path not in modules and \
+                    not [name for name in templates
+                         if path.endswith(os.sep + name)]:
+                return tests
+        selected = []
+        for test in tests:
+            uses = self.tests.get(_test_name(test))
+            if uses is None or _test_file(test) in changed or \
+                    set(uses['modules']).intersection(changed) or \
+                    [path for path in changed for name in uses['templates']
+                     if path.endswith(os.sep + name)]:
+                selected.append(test)
+        return selected
+
+    def start(self):
+        """Start recording dependencies, attributing them to the next test
+        reported with :meth:`record`."""
+        self._current = dict(endpoints=set(), modules=set(), templates=set())
+        _sinks.append(self._template_rendered)
+        _loaders.append(self._template_loaded)
+        request_started.connect(self._request_started)
+
+    def stop(self):
+        """Stop recording dependencies."""
+        _sinks.remove(self._template_rendered)
+        _loaders.remove(self._template_loaded)
+        request_started.disconnect(self._request_started)
+
+    def record(self, name):
+        """Store the dependencies recorded since the previous test as those
+        of the test `name`."""
+        current = self._current
+        self.tests[name] = dict((key, sorted(values))
+                                for key, values in current.iteritems())
+        for values in current.itervalues():
+            values.clear()
+
+    def _template_rendered(self, rendering):
+        self._template_loaded(rendering[0])
+
+    def _template_loaded(self, name):
+        if name is not None:
+            self._current['templates'].add(name)
+
+    def _request_started(self, app):
+        endpoint = request.endpoint
+        if endpoint is None:
+            return
+        self._current['endpoints'].add(endpoint)
+        view = app.view_functions.get(endpoint)
+        if view is not None:
+            try:
+                self._current['modules'].add(
+                    os.path.abspath(inspect.getsourcefile(view)))
+            except TypeError:
+                pass
+
+    def reporter(self, reporter=auto_reporter):
+        """Wrap a reporter to record the dependencies of the tests as they
+        run, saving the index when the run finishes."""
+        return _IndexingReporter(self, reporter)
+
+
+class _IndexingReporter(AbstractReporter):
+
+    def __init__(self, index, reporter):
+        if not isinstance(reporter, AbstractReporter):
+            reporter = reporter()
+        self.index, self.reporter = index, reporter
+
+    def begin(self, tests):
+        self.index.start()
+        self.reporter.begin(tests)
+
+    def success(self, result):
+        self.index.record(result.test_name)
+        self.reporter.success(result)
+
+    def failure(self, result):
+        self.index.record(result.test_name)
+        self.reporter.failure(result)
+
+    def finished(self):
+        self.index.stop()
+        self.index.save()
+        self.reporter.finished()
+
+
+def _test_name(test):
+    result = TestResult()
+    result.test = test
+    return result.test_name
+
+
+def _test_file(test):
+    return _module_file(sys.modules.get(test.__module__))
+
+
+def _module_file(module):
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return os.path.abspath(path)
+
+
+class Watcher(object):
+    """Reruns the tests affected by changes to files under `paths`, as
+    found by a :class:`DependencyIndex`, in one long-running process. The
+    `tests` are a collection, or the import path of one as a string to
+    have it reloaded along with its module. ::
+
+        index = DependencyIndex('.attest-index.json')
+        Watcher('tests.all', index).loop()
+
+    Changed modules that are imported are reloaded, and then every
+    application cached by a process-scoped :func:`request_context` is torn
+    down to be built again by the next test that needs it. Changed
+    templates need no reload. If a changed file isn't known to the index,
+    it's unknown what depends on it and all tests run, as with
+    :meth:`DependencyIndex.select`. Otherwise the application stays warm
+    between runs, and imports and interpreter startup happen only once.
+
+    """
+
+    def __init__(self, tests, index, paths=('.',), reporter=auto_reporter):
+        self.tests, self.index = tests, index
+        self.paths = paths
+        self.reporter = reporter
+        self._mtimes = None
+
+    def collection(self):
+        """The test collection, looked up again if given as a string."""
+        if not isinstance(self.tests, basestring):
+            return self.tests
+        module, name = self.tests.rsplit('.', 1)
+        return getattr(__import__(module, fromlist=[name]), name)
+
+    def scan(self):
+        """Return the paths of the files that changed since the last scan,
+        which is none for the first."""
+        mtimes = {}
+        for root in self.paths:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [name for name in dirnames
+                               if not name.startswith('.')]
+                for filename in filenames:
+                    if filename.endswith(('.pyc', '.pyo')):
+                        continue
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except OSError:
+                        pass
+        previous, self._mtimes = self._mtimes, mtimes
+        if previous is None:
+            return []
+        return sorted(path for path, mtime in mtimes.iteritems()
+                      if previous.get(path) != mtime)
+
+    def run(self, changed=()):
+        """Reload what `changed` and run the affected tests, or only the
+        tests the index doesn't know yet if nothing changed."""
+        self._reload(changed)
+        selected = self.index.select(self.collection(), changed)
+        if selected:
+            Tests([selected]).run(self.index.reporter(self.reporter))
+        return selected
+
+    def _reload(self, changed):
+        changed = set(changed)
+        stale = [module for name, module in sys.modules.items()
+                 if _module_file(module) in changed and name != __name__]
+        if stale:
+            # before the contexts of the old modules are let go
+            _shutdown_scoped()
+        for module in stale:
+            _reload_module(module)
+
+    def loop(self, interval=1.0):
+        """Run the tests the index doesn't know yet, then keep checking
+        for changes every `interval` seconds and run the affected tests,
+        until interrupted."""
+        self.scan()
+        self.run()
+        try:
+            while True:
+                time.sleep(interval)
+                changed = self.scan()
+                if changed:
+                    try:
+                        self.run(changed)
+                    except Exception:
+                        traceback.print_exc()
+        except KeyboardInterrupt:
+            pass
+
+
+def _reload_module(module):
+    """Like :func:`reload`, which Attest's import hook turns into a no-op
+    by returning modules that are already imported. The module is
+    imported anew and its namespace copied into the existing module
+    object, so references to it see the new code."""
+    name = module.__name__
+    del sys.modules[name]
+    try:
+        __import__(name)
+        fresh = sys.modules[name]
+    finally:
+        sys.modules[name] = module
+    module.__dict__.update(fresh.__dict__)
+    parent, _, attribute = name.rpartition('.')
+    if parent in sys.modules:
+        setattr(sys.modules[parent], attribute, module)
+
 
 signals = Namespace()
 template_rendered = signals.signal('template-rendered')
+template_rendered.connect(_forward)
@@ -1,9 +1,22 @@
 from __future__ import with_statement
+import sys
+import traceback
+from StringIO import StringIO
 from flask import (Module, request, redirect, Flask, Response, jsonify,
-                   render_template_string)
-from flaskext.attest import request_context, get, post, put, delete
+                   render_template, render_template_string, request_finished,
+                   _request_ctx_stack)
+from flaskext.attest import (request_context, get, post, put, delete,
+                             run_parallel, template_rendered, TestResponse,
+                             load, Profiler, sqlite_snapshot,
+                             sqlite_transaction, Recorder, replay,
+                             DependencyIndex, concurrently, ConcurrentClient,
+                             batch, ClientPool, CompiledRequest, find_leaks,
+                             History, run_shard, merge_shards, run_serial,
+                             Watcher, run_forked)
+from flask.testing import FlaskClient
 from flaskext.genshi import Genshi, generate_template
-from attest import Tests, raises, assert_hook
+from attest import (Tests, raises, assert_hook, AbstractReporter,
+                    capture_output)
 
 DEBUG = True
 TESTING = True
@@ -36,6 +49,27 @@ def elsewhere():
 def json():
     return jsonify(status='Success!')
 
+@mod.route('/cookie')
+def cookie():
+    response = Response('Set')
+    response.set_cookie('flavour', 'chocolate')
+    return response
+
+@mod.route('/stream/<int:lines>')
+def stream(lines):
+    return Response('line %d\n' % line for line in xrange(lines))
+
+@mod.route('/query/<int:count>')
+def query(count):
+    import sqlite3
+    connection = sqlite3.connect(':memory:')
+    connection.execute('select 1')
+    for number in xrange(count):
+        connection.execute('select ?', (number,))
+    connection.execute('select 1')
+    connection.close()
+    return 'Queried'
+
 @mod.route('/hello/<name>')
 def hello(name):
     return render_template_string('Hello {{name.capitalize()}}!', name=name)
@@ -118,6 +152,211 @@ def capture_templates(response, templates):
     assert (len(templates)) == 1
     assert (templates[0][0]) is (None)
     assert (templates[0][1]['name']) == 'world'
+    assert (templates[0].cached) is (False)
+    assert (templates[0].size) == 12
+    assert (templates[0].duration) >= 0
+
+@app.test
+@get('/stream/3')
+def compare_streamed(response, templates):
+    expected = Response(['line 0\n', 'line 1\n', 'line 2\n'])
+    assert (response) == expected
+    assert (response) == expected
+    assert (response) != Response('line 0\nline 1\nline 9\n')
+    assert (response) != Response('line 0\n')
+    assert (response.data) == 'line 0\nline 1\nline 2\n'
+
+@app.test
+def compare_large_streamed(client, templates):
+    produced = []
+    def stream():
+        for n in xrange(64):
+            produced.append(n)
+            yield 'x' * 65536
+    response = TestResponse(stream())
+    expected = Response(['y'] + ['x' * 65536] * 64)
+    equal = response == expected
+    assert not (equal)
+    assert (len(produced)) < 64
+    assert ('already read') in repr(response)
+    with raises(ValueError):
+        response == expected
+
+@app.test
+def compare_headers_in_order(client, templates):
+    response = TestResponse('x', headers=[('X-A', '1'), ('X-B', '2')])
+    reordered = Response('x', headers=[('X-B', '2'), ('X-A', '1')])
+    equal = response == reordered
+    assert not (equal)
+    diff = response.diff(reordered)
+    assert (diff.reordered) is (True)
+    assert ('headers: the same, in another order') in str(diff)
+
+    twice = TestResponse('x', headers=[('Set-Cookie', 'a=1')] * 2)
+    once = Response('x', headers=[('Set-Cookie', 'a=1')])
+    equal = twice == once
+    assert not (equal)
+    assert (twice.diff(once).unexpected) == [('Set-Cookie', 'a=1')]
+
+@app.test
+def response_diffs(client, templates):
+    lines = ['line %d' % n for n in xrange(1000)]
+    response = TestResponse('\n'.join(lines))
+    changed = list(lines)
+    changed[500] = 'changed'
+    del changed[800]
+    equal = response == Response('\n'.join(changed))
+    assert not (equal)
+    assert (response._attest_mismatch) is (None)
+    diff = str(response._mismatch())
+    assert (diff.splitlines()) == ['body (8889 bytes, expected 8879):',
+                                   '@@ line 501, expected line 501 @@',
+                                   '-changed', '+line 500',
+                                   '@@ line 801, expected line 801 @@',
+                                   '+line 800']
+    assert (diff) in repr(response)
+    equal = response == Response('\n'.join(lines))
+    assert (equal)
+    assert ('\n') not in repr(response)
+
+    response = client.get('/json')
+    diff = response.diff(jsonify(status='Failure!', items=[1]), limit=60)
+    assert (diff.status) is (None)
+    assert (diff.missing) == (diff.unexpected) == []
+    assert (diff.body) == ['- $.items: [1]', '$.status: "Success!", expected '
+                           '"Failure!"']
+    expected = Response('Success!', 404, mimetype='application/octet-stream')
+    diff = TestResponse('Succeeded!').diff(expected, limit=140)
+    assert (str(diff).splitlines()) == [
+        'status: 200 OK, expected 404 NOT FOUND', 'headers:',
+        '- Content-Type: application/octet-stream',
+        '+ Content-Type: text/html; charset=utf-8', 'body (10 b',
+        '... (diff truncated)']
+    assert (diff.body) == ['bodies differ from byte 5']
+    assert not (TestResponse('Same').diff(Response('Same')))
+
+@app.test
+def stream_assertions(client, templates):
+    import hashlib
+    response = client.get('/stream/1000')
+    assert (response.is_sequence) is (False)
+    found = response.contains('line 999\n', size=7)
+    missing = client.get('/stream/10').contains('line 10', size=7)
+    assert (found, missing) == (True, False)
+    match = client.get('/stream/100').search(r'line (5\d)', size=5)
+    assert (match.group(1)) == '50'
+    lines = list(client.get('/stream/20').iter_lines(size=3))
+    assert (lines) == ['line %d' % n for n in xrange(20)]
+    body = ''.join('line %d\n' % n for n in xrange(50))
+    digest = client.get('/stream/50').digest()
+    assert (digest) == hashlib.sha1(body).hexdigest()
+    blocks = [len(block) for block in TestResponse(body).iter_chunks(100)]
+    assert (blocks) == [100] * 3 + [len(body) - 300]
+
+@app.test
+@load(get('/hello/load'), (3, get('/json')), get('/error'), total=50,
+      concurrency=5)
+def load_test(report, templates):
+    assert (report.requests) == 40
+    assert (report.statuses) == {200: 40}
+    assert (len(report.errors)) == 10
+    assert (len(templates)) == 10
+    assert (report.p50) <= (report.p95) <= (report.p99)
+    assert (report.throughput) > 0
+    with raises(TypeError):
+        load(total=10)
+    with raises(TypeError):
+        load((0, get('/json')))
+
+@app.test
+@concurrently(get('/hello/one'), get('/json'), get('/hello/two'), workers=2)
+def concurrent_requests(responses, templates):
+    assert (responses) == [Response('Hello One!'),
+                           jsonify(status='Success!'),
+                           Response('Hello Two!')]
+    assert (len(templates)) == 2
+
+@app.test
+def concurrent_client(client, templates):
+    with ConcurrentClient(client.application, 3) as pool:
+        futures = [pool.get('/hello/%d' % n) for n in xrange(10)]
+        failing = pool.get('/error')
+        responses = [future.result() for future in futures]
+        with raises(ZeroDivisionError):
+            failing.result()
+    assert ([response.data for response in responses]) == \
+           ['Hello %d!' % n for n in xrange(10)]
+    assert (failing.done()) is (True)
+    functions = []
+    try:
+        failing.result()
+    except ZeroDivisionError:
+        functions = [entry[2] for entry
+                     in traceback.extract_tb(sys.exc_info()[2])]
+    assert ('error') in (functions)
+
+    class BrokenClient(FlaskClient):
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError('broken client')
+
+    broken = Flask(__name__)
+    broken.test_client_class = BrokenClient
+    with ConcurrentClient(broken, 2) as pool:
+        futures = [pool.get('/') for _ in xrange(3)]
+        for future in futures:
+            with raises(RuntimeError):
+                future.result(timeout=5)
+
+@app.test
+@batch([('/hello/batch', Response('Hello Batch!')),
+        ('/404', 404),
+        (put('/', data={'message': 'Batched'}), Response('Success!')),
+        (get('/'), Response('Batched')),
+        (get('/json'), 404)])
+def batched_requests(rows, templates):
+    rows = list(rows)
+    assert ([row.passed for row in rows]) == [True] * 4 + [False]
+    assert (repr(rows[-1])) == '<BatchRow GET /json: 200, expected 404 ' \
+                               '(failed)>'
+
+@app.test
+def compiled_requests(client, templates):
+    compiled = CompiledRequest(('/?page=2',), dict(method='PUT',
+                                                   data={'message': 'Again'}))
+    for _ in xrange(2):
+        with capture_output():
+            args, kwargs = compiled.arguments()
+            response = client.open(*args, **kwargs)
+            assert (request.environ['wsgi.errors']) is (sys.stderr)
+        assert (response) == Response('Success!')
+        assert (request.args['page']) == '2'
+        assert (db['index']) == 'Again'
+        db.clear()
+    args, kwargs = CompiledRequest(('/elsewhere',),
+                                   dict(follow_redirects=True)).arguments()
+    assert (kwargs['follow_redirects']) is (True)
+    errors = StringIO()
+    args, kwargs = CompiledRequest(('/',),
+                                   dict(errors_stream=errors)).arguments()
+    assert (kwargs['environ_overrides']['wsgi.errors']) is (errors)
+
+@app.test
+@batch([('/hello/batch', Response('Hi!'))])
+def batch_diffs(rows, templates):
+    row = rows.next()
+    assert (repr(row)) == '<BatchRow GET /hello/batch: 200, expected 200 ' \
+                          '(failed)>\nbody (12 bytes, expected 3):\n' \
+                          '@@ line 1, expected line 1 @@\n-Hi!\n' \
+                          '+Hello Batch!'
+
+@app.test
+@batch([('/stream/200000', Response('Hi!'))])
+def batch_large_streamed(rows, templates):
+    row = rows.next()
+    assert not (row.passed)
+    assert not (row.passed)
+    assert ('already read') in (repr(row))
+    assert ('already read') in (repr(row))
 
 @app.test
 def genshi_templates(client, templates):
@@ -126,6 +365,778 @@ def genshi_templates(client, templates):
     assert (len(templates)) == 1
     assert (templates[0][0]) is (None)
     assert (templates[0][1]['name']) == 'world'
+    assert (templates[0].cached) is (False)
+    assert (templates[0].duration) is (templates[0].size) is (None)
+
+@app.test
+def other_toolkits(client, templates):
+    template_rendered.send(None, template='other.txt', context={})
+    assert (templates) == [('other.txt', {})]
+
+
+builds = []
+
+@request_context(scope='process', reset=lambda app: db.clear())
+def cachedapp():
+    builds.append(True)
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    app.register_module(mod)
+    yield app
+    builds.remove(True)
+
+cached = Tests(contexts=[cachedapp])
+
+@cached.test
+@put('/', data={'message': 'Cached'})
+def cached_put(response, templates):
+    assert (db['index']) == 'Cached'
+
+@cached.test
+@get('/hello/cached')
+def cached_reuse(response, templates):
+    assert (len(builds)) == 1
+    assert ('index') not in (db)
+    assert (len(templates)) == 1
+    assert (templates[0][1]['name']) == 'cached'
+
+@cached.test
+def cached_shutdown(client, templates):
+    cachedapp.shutdown()
+    assert (builds) == []
+
+app.register(cached)
+
+
+def capturing(**options):
+    @request_context(**options)
+    def context():
+        app = Flask(__name__)
+        app.register_module(mod)
+        yield app
+    return context
+
+captures = Tests()
+
+@captures.test
+def capture_names():
+    with capturing(capture='names')() as (client, templates):
+        client.get('/hello/world')
+        assert (templates) == [(None, None)]
+
+@captures.test
+def capture_keys():
+    with capturing(capture=['name', 'missing'])() as (client, templates):
+        client.get('/hello/world')
+        assert (templates) == [(None, {'name': 'world'})]
+
+@captures.test
+def capture_limit():
+    with capturing(capture_limit=2)() as (client, templates):
+        for name in ('one', 'two', 'three'):
+            client.get('/hello/' + name)
+        assert ([context['name'] for _, context in templates]) == \
+               ['two', 'three']
+
+@captures.test
+def capture_off():
+    with capturing(capture=None)() as (client, templates):
+        client.get('/hello/world')
+        assert (templates) == []
+    with raises(ValueError):
+        capturing(capture='everything')
+
+@request_context
+def pagesapp():
+    from jinja2 import FunctionLoader
+    app = Flask(__name__)
+    source = lambda name: ('Page {{ number }}', None, lambda: True)
+    app.jinja_env.loader = FunctionLoader(source)
+
+    @app.route('/page/<int:number>')
+    def page(number):
+        return render_template('page.html', number=number)
+
+    yield app
+
+@captures.test
+def capture_timing():
+    with pagesapp() as (client, templates):
+        client.get('/page/1')
+        client.get('/page/22')
+    assert ([entry.name for entry in templates]) == ['page.html'] * 2
+    assert ([entry.cached for entry in templates]) == [False, True]
+    assert ([entry.size for entry in templates]) == [6, 7]
+    assert (min(entry.duration for entry in templates)) >= 0
+    assert (templates[1].context['number']) == 22
+
+    with pagesapp() as (client, templates):
+        client.application.jinja_env.cache = None
+        client.get('/page/1')
+        client.get('/page/1')
+    assert ([entry.cached for entry in templates]) == [False, False]
+
+    with capturing(capture=['name'])() as (client, templates):
+        template_rendered.send(None, template='other.txt', context={},
+                               duration=0.5, size=10)
+    assert (templates) == [('other.txt', {})]
+    assert (templates[0].duration) == 0.5
+    assert (templates[0].size) == 10
+    assert (templates[0].cached) is (None)
+
+app.register(captures)
+
+
+class ResettingClient(FlaskClient):
+
+    resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+pool = ClientPool()
+
+@request_context(scope='process', client_pool=pool)
+def pooledapp():
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    app.test_client_class = ResettingClient
+    app.register_module(mod)
+    yield app
+
+pooled = Tests(contexts=[pooledapp])
+clients = []
+
+@pooled.test
+def pooled_first(client, templates):
+    clients.append(client)
+    client.get('/cookie')
+    assert (len(client.cookie_jar)) == 1
+    assert (client.resets) == 0
+
+@pooled.test
+def pooled_second(client, templates):
+    assert (client) is (clients[0])
+    assert (client.resets) == 1
+    assert (len(client.cookie_jar)) == 0
+    other = pool.acquire(client.application, ResettingClient)
+    assert (other) is not (client)
+    pooledapp.shutdown()
+
+@app.test
+def pooled_per_application(client, templates):
+    created = Flask(__name__)
+    first = pool.acquire(created, FlaskClient)
+    pool.release(first)
+    assert (created._attest_idle_clients) == {(pool, FlaskClient): [first]}
+    other = pool.acquire(Flask(__name__), FlaskClient)
+    reused = pool.acquire(created, FlaskClient)
+    assert (other) is not (first)
+    assert (reused) is (first)
+
+    with raises(ValueError):
+        request_context(client_pool=pool)(lambda: iter([created]))
+
+app.register(pooled)
+
+
+profiler = Profiler()
+profiled = Tests(contexts=[capturing(profiler=profiler)])
+
+@profiled.test
+def profile_requests(client, templates):
+    client.get('/hello/world')
+    client.post('/', data={'message': 'Profiled'})
+    client.get('/404')
+    profile = profiler.current
+    assert (profile.setup) >= 0
+    assert ([(r.method, r.path, r.endpoint, r.status_code)
+             for r in profile.requests]) == [
+        ('GET', '/hello/world', 'tests.hello', 200),
+        ('POST', '/', 'tests.index', 200),
+        ('GET', '/404', None, 404)]
+    first = profile.requests[0]
+    assert (first.templates) == [None]
+    assert (first.size) == len('Hello World!')
+    assert (first.wall) >= 0 and (first.memory) is (None)
+
+@profiled.test
+def profile_summary():
+    previous = profiler.tests[-2]
+    assert (previous.total) >= (previous.setup)
+    summary = profiler.slowest()
+    assert (sorted(endpoint for endpoint, count, total, worst
+                   in summary)) == [None, 'tests.hello', 'tests.index']
+    assert (summary[0][2]) >= (summary[-1][2])
+
+@profiled.test
+def profile_streamed(client, templates):
+    response = client.get('/stream/3')
+    record = profiler.current.requests[0]
+    assert (record.size) is (None)
+    assert (response.data) == 'line 0\nline 1\nline 2\n'
+    assert (record.size) == 21
+
+app.register(profiled)
+
+
+queried = Tests(contexts=[capturing(queries=True)])
+
+@queried.test
+@get('/query/3')
+def log_queries(response, templates, queries):
+    assert ([query.sql for query in queries]) == ['select 1'] + \
+                                                 ['select ?'] * 3 + \
+                                                 ['select 1']
+    assert ([query.parameters for query in queries[1:4]]) == [
+        (0,), (1,), (2,)]
+    assert (set(query.path for query in queries)) == set(['/query/3'])
+    assert (queries.total_time) >= 0
+    assert (queries.duplicates()) == {('select 1', ()): 2}
+    assert (queries.duplicates(parameters=False)) == {'select 1': 2,
+                                                      'select ?': 3}
+
+@queried.test
+def queries_outside_requests(client, templates, queries):
+    import sqlite3
+    connection = sqlite3.connect(':memory:')
+    connection.execute('create table numbers (number integer)')
+    connection.cursor().executemany('insert into numbers values (?)',
+                                    iter([(1,), (2,)]))
+    assert (queries) == []
+    client.get('/query/0')
+    assert (len(queries)) == 2
+    connection.close()
+
+app.register(queried)
+
+@app.test
+def queries_unpatched(client, templates):
+    import sqlite3
+    from flaskext import attest
+    assert (sqlite3.connect) is (attest._sqlite_connect)
+    assert (sqlite3.dbapi2.connect) is (attest._sqlite_connect)
+
+
+class Leaked(object):
+    pass
+
+retained = []
+
+@request_context(scope='process')
+def leakyapp():
+    app = Flask(__name__)
+
+    @app.route('/leak')
+    def leak():
+        retained.append(Leaked())
+        request_finished.connect(lambda sender, **extra: None, app,
+                                 weak=False)
+        return 'Leaked'
+
+    yield app
+
+leaks = Tests()
+
+@leaks.test
+def no_leaks():
+    report = find_leaks(cachedapp, get('/hello/world'), runs=5)
+    assert not (report.leaking)
+    assert (report.runs) == 5
+    assert (str(report)) == '5 runs'
+
+@leaks.test
+def leaking_endpoint():
+    report = find_leaks(leakyapp, get('/leak'), runs=5)
+    assert (report.leaking)
+    assert (report.objects['Leaked']) == 5
+    assert (report.receivers) == {'flask.request_finished': 5}
+    assert ('flask.request_finished receivers: +5') in str(report)
+    leakyapp.shutdown()
+
+@leaks.test
+def leaking_contexts():
+    def test(client, templates):
+        client.application.test_request_context().push()
+    report = find_leaks(leakyapp, test, runs=3, warmup=0)
+    assert (report.contexts) == 3
+    for _ in xrange(3):
+        _request_ctx_stack.pop()
+    leakyapp.shutdown()
+
+app.register(leaks)
+
+
+databases = Tests()
+
+@databases.test
+def snapshot_database():
+    import os
+    import sqlite3
+    app = Flask(__name__)
+    schemas = []
+
+    def init_db():
+        schemas.append(app.config['DATABASE'])
+        db = sqlite3.connect(app.config['DATABASE'])
+        db.execute('create table entries (text)')
+        db.commit()
+        db.close()
+
+    tempdb = sqlite_snapshot(init_db, app)
+    paths = []
+    for text in ('first', 'second'):
+        with tempdb():
+            paths.append(app.config['DATABASE'])
+            db = sqlite3.connect(app.config['DATABASE'])
+            assert (db.execute('select * from entries').fetchall()) == []
+            db.execute('insert into entries values (?)', [text])
+            db.commit()
+            db.close()
+    assert (len(schemas)) == 1
+    assert (len(set(paths + schemas))) == 3
+    assert not [path for path in paths if os.path.exists(path)]
+    tempdb.shutdown()
+    assert not os.path.exists(schemas[0])
+
+    def init_current():
+        from flask import current_app
+        schemas.append(current_app.config['DATABASE'])
+        db = sqlite3.connect(current_app.config['DATABASE'])
+        db.execute('create table entries (text)')
+        db.commit()
+        db.close()
+
+    @request_context
+    def factoryapp():
+        yield Flask(__name__)
+
+    tempdb = sqlite_snapshot(init_current)
+    apps = []
+    for _ in xrange(2):
+        with factoryapp() as (client, templates):
+            with tempdb():
+                apps.append(client.application)
+                db = sqlite3.connect(client.application.config['DATABASE'])
+                rows = db.execute('select * from entries').fetchall()
+                db.close()
+                assert (rows) == []
+    assert (len(schemas)) == 2
+    assert (apps[0]) is not (apps[1])
+    tempdb.shutdown()
+    with raises(RuntimeError):
+        with tempdb():
+            pass
+
+@databases.test
+def rollback_database():
+    import os
+    import sqlite3
+    import tempfile
+    from types import ModuleType
+    path = tempfile.mkstemp()[1]
+    store = ModuleType('store')
+    store.connect_db = lambda: sqlite3.connect(path)
+    db = store.connect_db()
+    db.execute('create table entries (text)')
+    db.commit()
+    db.close()
+
+    app = Flask(__name__)
+
+    @app.route('/add/<text>')
+    def add(text):
+        db = store.connect_db()
+        db.execute('insert into entries values (?)', [text])
+        db.commit()
+        db.close()
+        return 'Added'
+
+    @app.route('/count')
+    def count():
+        db = store.connect_db()
+        return str(db.execute('select count(*) from entries').fetchone()[0])
+
+    connect = store.connect_db
+    with sqlite_transaction(store)():
+        client = app.test_client()
+        client.get('/add/one')
+        client.get('/add/two')
+        assert (client.get('/count').data) == '2'
+    assert (store.connect_db) is (connect)
+    db = store.connect_db()
+    assert (db.execute('select * from entries').fetchall()) == []
+    db.close()
+    os.unlink(path)
+
+app.register(databases)
+
+
+replays = Tests()
+
+@replays.test
+def record_and_replay():
+    import os
+    import tempfile
+    path = tempfile.mkstemp(suffix='.json.gz')[1]
+    os.unlink(path)
+    recorder = Recorder(path)
+    with capturing(recorder=recorder)() as (client, templates):
+        client.post('/', data={'message': 'Recorded'})
+        client.get('/')
+        client.get('/elsewhere', follow_redirects=True)
+        client.get('/hello/world?x=1', headers=[('X-Test', 'yes')])
+    recorder.close()
+
+    app = Flask(__name__)
+    app.register_module(mod)
+    assert (list(replay(path, app, batch_size=2))) == []
+
+    @app.after_request
+    def change(response):
+        if request.path == '/hello/world':
+            response.data = 'Changed'
+        return response
+
+    mismatches = list(replay(path, app))
+    assert ([m.record['path'] for m in mismatches]) == ['/hello/world']
+    assert (mismatches[0].response.data) == 'Changed'
+    assert (mismatches[0].expected.data) == 'Hello World!'
+    os.unlink(path)
+
+app.register(replays)
+
+
+class Collect(AbstractReporter):
+
+    def begin(self, tests):
+        self.total = len(tests)
+        self.passed, self.failed = [], []
+
+    def success(self, result):
+        self.passed.append(result.test_name)
+
+    def failure(self, result):
+        self.failed.append(result)
+
+    def finished(self):
+        self.passed.sort()
+
+
+sample = Tests(contexts=[testapp])
+
+@sample.test
+@get('/hello/one')
+def sample_one(response, templates):
+    assert (response) == Response('Hello One!')
+
+@sample.test
+@get('/hello/two')
+def sample_two(response, templates):
+    assert (response) == Response('Hello Two!')
+
+@sample.test
+@get('/hello/three')
+def sample_broken(response, templates):
+    print('broken')
+    assert (response) == Response('Hello Four!')
+
+runners = Tests()
+
+@runners.test
+def parallel():
+    reporter = Collect()
+    run_parallel(sample, 2, reporter)
+    assert (reporter.total) == 3
+    assert (reporter.passed) == ['tests.sample_one', 'tests.sample_two']
+    assert (len(reporter.failed)) == 1
+    failure = reporter.failed[0]
+    assert (failure.test_name) == 'tests.sample_broken'
+    assert (failure.stdout) == ['broken']
+    assert isinstance(failure.error, AssertionError)
+    assert ('sample_broken') in (failure.traceback)
+
+    one, two, broken = list(sample)
+    exiting = list(forkable)[-1]
+    reporter = Collect()
+    run_parallel([exiting, one, two], 1, reporter)
+    assert (reporter.passed) == ['tests.sample_one', 'tests.sample_two']
+    failure = reporter.failed[0]
+    assert (str(failure.error)) == 'test process exited with status 3'
+
+@runners.test
+def dependency_index():
+    import os
+    import tempfile
+    path = tempfile.mkstemp()[1]
+    os.unlink(path)
+    index = DependencyIndex(path)
+    assert (len(index.select(sample, ['tests.py']))) == 3
+    sample.run(index.reporter(Collect()))
+
+    index = DependencyIndex(path)
+    uses = index.tests['tests.sample_one']
+    assert (uses['endpoints']) == ['tests.hello']
+    assert (uses['modules']) == [os.path.abspath('tests.py')]
+    assert (len(index.select(sample, ['other.py']))) == 3
+    assert (len(index.select(sample, ['schema.sql']))) == 3
+    assert (len(index.select(sample, ['tests.py']))) == 3
+    assert (len(index.select(sample, ['templates/unused.html']))) == 3
+    assert (index.select(sample, [path])) == []
+
+    uses['templates'] = ['hello.html']
+    selected = index.select(sample, ['templates/hello.html', 'hello.html'])
+    assert (selected) == [list(sample)[0]]
+    os.unlink(path)
+
+LAYOUTS = {'layout.html': '<{% block body %}{% endblock %}>',
+           'page.html': '{% extends "layout.html" %}'
+                        '{% block body %}{% include "part.html" %}'
+                        '{% endblock %}',
+           'part.html': 'part'}
+
+@request_context(capture=None)
+def layoutapp():
+    from jinja2 import FunctionLoader
+    app = Flask(__name__)
+    app.jinja_env.loader = FunctionLoader(
+        lambda name: (LAYOUTS[name], None, lambda: True))
+
+    @app.route('/page')
+    def page():
+        return render_template('page.html')
+
+    yield app
+
+layouts = Tests(contexts=[layoutapp])
+
+@layouts.test
+@get('/page')
+def layout_page(response, templates):
+    assert (response.data) == '<part>'
+    assert (templates) == []
+
+@runners.test
+def dependency_index_layouts():
+    import os
+    import tempfile
+    path = tempfile.mkstemp()[1]
+    os.unlink(path)
+    index = DependencyIndex(path)
+    Tests([sample, layouts]).run(index.reporter(Collect()))
+    uses = index.tests['tests.layout_page']
+    assert (uses['templates']) == ['layout.html', 'page.html', 'part.html']
+    everything = list(sample) + list(layouts)
+    selected = index.select(everything, ['templates/layout.html'])
+    assert (selected) == list(layouts)
+    os.unlink(path)
+
+@runners.test
+def shards():
+    import os
+    import tempfile
+    path = tempfile.mkstemp()[1]
+    os.unlink(path)
+    history = History(path)
+    for name, duration in [('tests.sample_one', 3.0),
+                           ('tests.sample_two', 1.0),
+                           ('tests.sample_broken', 1.0)]:
+        history.record(name, duration)
+    history.record('tests.sample_one', 5.0)
+    assert (history.duration('tests.sample_one')) == 4.0
+    assert (history.duration('tests.missing')) is (None)
+    one, two, broken = list(sample)
+    assert (history.shards(sample, 2)) == [[one], [two, broken]]
+    assert (history.shards(sample, 4)) == [[one], [two], [broken], []]
+
+    results = []
+    for index in xrange(2):
+        results.append(tempfile.mkstemp()[1])
+        run_shard(sample, index, 2, results[index], history)
+    reporter = Collect()
+    merge_shards(sample, results, reporter, History(path))
+    assert (reporter.total) == 3
+    assert (reporter.passed) == ['tests.sample_one', 'tests.sample_two']
+    assert (reporter.failed[0].stdout) == ['broken']
+    assert (len(History(path).tests['tests.sample_two']['durations'])) == 1
+
+    with open(results[1], 'rb') as f:
+        data = f.read()
+    with open(results[1], 'wb') as f:
+        f.write(data[:len(data) // 2])
+    reporter = Collect()
+    merge_shards(sample, results + [results[1] + '.missing'], reporter)
+    assert (reporter.total) == 3
+    assert (reporter.passed) == ['tests.sample_one', 'tests.sample_two']
+    failure = reporter.failed[0]
+    assert (failure.test_name) == 'tests.sample_broken'
+    assert ('no shard reported') in (str(failure.error))
+
+    os.unlink(results[1])
+    reporter = Collect()
+    merge_shards(sample, results, reporter)
+    assert ([result.test_name for result in reporter.failed]) == \
+        ['tests.sample_two', 'tests.sample_broken']
+    os.unlink(results[0])
+    os.unlink(path)
+
+@runners.test
+def scheduling():
+    import os
+    import tempfile
+    path = tempfile.mkstemp()[1]
+    os.unlink(path)
+    history = History(path)
+    one, two, broken = list(sample)
+    assert (history.schedule(sample)) == [one, two, broken]
+    run_serial(sample, history.reporter(Collect()))
+
+    history = History(path)
+    assert (history.failed_last('tests.sample_broken')) is (True)
+    assert (history.failure_rate('tests.sample_broken')) == 1.0
+    assert (history.failure_rate('tests.sample_one')) == 0.0
+    history.record('tests.sample_two', 10.0)
+    assert (history.schedule(sample)) == [broken, two, one]
+    history.record('tests.sample_broken', 0.0)
+    history.record('tests.sample_one', 0.0, failed=True)
+    assert (history.failure_rate('tests.sample_broken')) == 0.5
+    assert (history.schedule(sample)) == [one, broken, two]
+    os.unlink(path)
+
+@runners.test
+def failfast():
+    one, two, broken = list(sample)
+    reporter = Collect()
+    run_serial([one, broken, two], reporter, failfast=True)
+    assert (reporter.total) == 3
+    assert (reporter.passed) == ['tests.sample_one']
+    assert (reporter.failed[0].test_name) == 'tests.sample_broken'
+
+    reporter = Collect()
+    run_parallel([broken] + [one] * 20, 1, reporter, failfast=True)
+    assert (len(reporter.failed)) == 1
+    assert (len(reporter.passed)) < 20
+
+WATCHED = """from flask import Flask, render_template_string
+from flaskext.attest import request_context
+
+def create_app():
+    app = Flask(__name__)
+
+    @app.route('/')
+    def index():
+        return render_template_string(%r)
+
+    return app
+
+@request_context(scope='process')
+def watchedapp():
+    yield create_app()
+"""
+
+@request_context(scope='process')
+def watchedapp():
+    import watched
+    yield watched.create_app()
+
+watchable = Tests(contexts=[watchedapp])
+
+@watchable.test
+@get('/')
+def watched_index(response, templates):
+    assert (response.data) == 'Hello'
+
+@runners.test
+def watch():
+    import gc
+    import os
+    import sys
+    import tempfile
+    from flaskext import attest
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'watched.py')
+    with open(source, 'w') as f:
+        f.write(WATCHED % 'Hello')
+    sys.path.insert(0, directory)
+    index = DependencyIndex(os.path.join(directory, 'index.json'))
+    reporter = Collect()
+    watcher = Watcher(watchable, index, [directory], reporter)
+    try:
+        changed = watcher.scan()
+        assert (changed) == []
+        watcher.run()
+        assert (reporter.passed) == ['tests.watched_index']
+        gc.collect()
+        scoped = len(attest._scoped)
+        assert (index.tests['tests.watched_index']['modules']) == [source]
+        changed = watcher.scan()
+        assert (changed) == [index.path]
+        selected = watcher.run([index.path])
+        assert (selected) == []
+
+        with open(source, 'w') as f:
+            f.write(WATCHED % 'Goodbye')
+        os.utime(source, (0, 0))
+        changed = watcher.scan()
+        assert (changed) == [source]
+        watcher.run(changed)
+        assert (len(reporter.failed)) == 1
+        gc.collect()
+        assert (len(attest._scoped)) == (scoped)
+    finally:
+        sys.path.remove(directory)
+        sys.modules.pop('watched', None)
+        watchedapp.shutdown()
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+forkable = Tests(contexts=[cachedapp])
+
+@forkable.test
+@put('/', data={'message': 'Forked'})
+def forked_put(response, templates):
+    assert (db['index']) == 'Forked'
+    db['forked'] = True
+
+@forkable.test
+def forked_isolation(client, templates):
+    assert ('forked') not in (db)
+
+@forkable.test
+def forked_exit(client, templates):
+    import os
+    os._exit(3)
+
+@runners.test
+def forked():
+    db.clear()
+    reporter = Collect()
+    run_forked(forkable, reporter, [cachedapp])
+    assert (builds) == [True]
+    assert (reporter.passed) == ['tests.forked_isolation', 'tests.forked_put']
+    failure = reporter.failed[0]
+    assert (str(failure.error)) == 'test process exited with status 3'
+    assert (db) == {}
+
+    reporter = Collect()
+    run_forked(reversed(list(forkable)), reporter, [cachedapp], batch=2,
+               failfast=True)
+    assert (reporter.passed) == []
+    assert (len(reporter.failed)) == 1
+
+    one, two, broken = list(sample)
+    reporter = Collect()
+    run_forked([broken, one, two], reporter, [], batch=3, failfast=True)
+    assert (reporter.passed) == []
+    assert (reporter.failed[0].stdout) == ['broken']
+    reporter = Collect()
+    run_forked([one, two], reporter, [], batch=2)
+    assert (reporter.passed) == ['tests.sample_one', 'tests.sample_two']
+    cachedapp.shutdown()
+    assert (builds) == []
+
+app.register(runners)
 
 
 if __name__ == '__main__':